@@ -0,0 +1,179 @@
+import asyncio
+import copy
+import inspect
+import logging
+import threading
+import time
+from functools import wraps
+
+from telegram import Message, TelegramError, Update
+from telegram.error import RetryAfter
+
+import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+def api_method(name):
+    # send_video_note -> sendVideoNote
+    parts = name.split('_')
+    return parts[0] + ''.join(part.title() for part in parts[1:])
+
+
+def api_value(value):
+    if isinstance(value, list):
+        return [api_value(item) for item in value]
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return value
+
+
+class AsyncBot:
+    # coroutine counterpart of a telegram.Bot: async_bot.send_message(chat_id=..., text=...) awaits the Bot API call
+    def __init__(self, runtime, bot):
+        self.runtime = runtime
+        self.bot = bot
+        self.url = '%s/' % bot.base_url
+
+    async def call(self, method, **params):
+        start = time.time()
+        try:
+            result = await self._call(method, **params)
+        except Exception as e:
+            metrics.record_api_call(method, start, e)
+            raise
+        metrics.record_api_call(method, start)
+        return result
+
+    async def _call(self, method, **params):
+        data = {key: api_value(value) for (key, value) in params.items() if value is not None}
+        async with self.runtime.session.post(self.url + method, json=data) as response:
+            payload = await response.json(content_type=None)
+        if payload.get('ok'):
+            result = payload['result']
+            if isinstance(result, dict) and 'message_id' in result:
+                return Message.de_json(result, self.bot)
+            return result
+        parameters = payload.get('parameters') or {}
+        if 'retry_after' in parameters:
+            raise RetryAfter(parameters['retry_after'])
+        raise TelegramError(payload.get('description', 'Unknown Bot API error'))
+
+    def __getattr__(self, name):
+        method = api_method(name)
+
+        async def call(**params):
+            return await self.call(method, **params)
+
+        return call
+
+
+class NonBlockingBot:
+    # passed to handlers in asyncio mode: Bot API calls are scheduled on the event loop and return a
+    # concurrent.futures.Future instead of blocking the dispatcher thread, everything else is the wrapped bot.
+    # get_* lookups return their result, handlers make them through ChatCache so they rarely reach the API.
+    def __init__(self, runtime, bot):
+        self.runtime = runtime
+        self.bot = bot
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if not callable(attribute) or not hasattr(attribute, '__self__') or name.startswith('get_'):
+            return attribute
+
+        def call(*args, **params):
+            if len(args) > 0:
+                # Message.reply_text and CallbackQuery.answer pass chat ids, texts and query ids positionally
+                params = keyword_arguments(attribute, args, params)
+            future = self.runtime.submit(attribute, **params)
+            future.add_done_callback(log_error)
+            return future
+
+        return call
+
+
+def keyword_arguments(method, args, params):
+    signature = inspect.signature(method)
+    arguments = {}
+    for (name, value) in signature.bind_partial(*args, **params).arguments.items():
+        if signature.parameters[name].kind == inspect.Parameter.VAR_KEYWORD:
+            arguments.update(value)
+        else:
+            arguments[name] = value
+    return arguments
+
+
+def bind(update, bot):
+    # shallow copies of the update and its message or callback query that use bot, so replies made through them
+    # don't block the dispatcher thread either. Other handlers of the update keep the original objects.
+    bound = copy.copy(update)
+    bound._effective_message = None
+    for name in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query'):
+        value = getattr(update, name)
+        if value is None:
+            continue
+        value = copy.copy(value)
+        value.bot = bot
+        if name == 'callback_query' and value.message is not None:
+            value.message = copy.copy(value.message)
+            value.message.bot = bot
+        setattr(bound, name, value)
+    return bound
+
+
+def log_error(future):
+    if future.exception() is not None:
+        logger.warning('Bot API call failed: %s' % future.exception())
+
+
+# Runs an asyncio event loop on its own thread with one pooled aiohttp session. Bot API calls from any
+# thread are turned into coroutines on that loop, so thousands of sends and replies can be in flight at once.
+class AsyncRuntime:
+    def __init__(self, connections=100):
+        if aiohttp is None:
+            raise RuntimeError('asyncio execution mode requires the aiohttp package')
+        self.connections = connections
+        self.loop = asyncio.new_event_loop()
+        self.bots = {}
+        self.thread = threading.Thread(target=self._run, name='asyncio-runtime', daemon=True)
+        self.thread.start()
+        self.session = self.run(self._create_session()).result()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def bot_for(self, bot):
+        if bot.token not in self.bots:
+            self.bots[bot.token] = AsyncBot(self, bot)
+        return self.bots[bot.token]
+
+    def submit(self, func, **params):
+        # func is a bound telegram.Bot method, run its coroutine counterpart on the loop
+        async_bot = self.bot_for(func.__self__)
+        return self.run(getattr(async_bot, func.__name__)(**params))
+
+    def adapt(self, callback):
+        @wraps(callback)
+        def wrapped(bot, update, *args, **kwargs):
+            bot = NonBlockingBot(self, bot)
+            if isinstance(update, Update):
+                update = bind(update, bot)
+            return callback(bot, update, *args, **kwargs)
+
+        return wrapped
+
+    def close(self):
+        self.run(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _create_session(self):
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from fakes import FakeUpdater, make_callback_update, make_config, make_update, wait_for_sends
+
+import channel_instance_handler
+import channel_queue_bot
+from config_writer import ConfigWriter
+from send_scheduler import SendScheduler
+
+# operations timed per case; queues are pre-filled to the requested size first
+OPERATIONS = 1000
+
+
+def make_handler(size, per_post=1, channel_id=-1000, updater=None):
+    if updater is None:
+        updater = FakeUpdater()
+    config = channel_queue_bot.config
+    config['channels'][str(channel_id)] = dict(config['default_settings'], queued_posts=[], post_times=[],
+                                               per_post=per_post)
+    handler = channel_instance_handler.ChannelInstanceHandler(updater, channel_id, config)
+    handler.config['queued_posts'] = fill_queue(size)
+    handler.load_queue()
+    return handler
+
+
+def fill_queue(size):
+    return [[index, 'p' if index % 3 else 't', 'FILE%d' % index, None] for index in range(1, size + 1)]
+
+
+def timed(func, operations):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'operations': operations, 'ops_per_second': operations / elapsed if elapsed else 0}
+
+
+def bench_add_text(size):
+    handler = make_handler(size)
+    # distinct contents, repeats would be turned away as duplicates
+    updates = [make_update(handler.bot, text='benchmark text: with a colon %d' % index) for index in range(OPERATIONS)]
+
+    def run():
+        for update in updates:
+            handler.add_text(handler.bot, update)
+
+    return timed(run, OPERATIONS)
+
+
+def bench_add_media(size):
+    handler = make_handler(size)
+    updates = [make_update(handler.bot, photo='NEW%d' % index, caption='caption') for index in range(OPERATIONS)]
+
+    def run():
+        for update in updates:
+            handler.add_media(handler.bot, update)
+
+    return timed(run, OPERATIONS)
+
+
+def bench_remove_post(size):
+    handler = make_handler(size)
+    update = make_callback_update(handler.bot, 'remove')
+    # spread removals over the whole queue, the old list scan was worst for posts near the end
+    step = max(1, size // OPERATIONS)
+    post_ids = list(range(size, 0, -step))[:OPERATIONS]
+
+    def run():
+        for post_id in post_ids:
+            handler.remove_post(handler.bot, update, post_id)
+
+    return timed(run, len(post_ids))
+
+
+def bench_shuffle(size):
+    handler = make_handler(size)
+    return timed(lambda: handler.shuffle(handler.bot, None), 1)
+
+
+def bench_push_post(size):
+    handler = make_handler(size, per_post=2)
+    operations = min(OPERATIONS, size // 2)
+
+    def run():
+        for index in range(operations):
+            handler.push_post(handler.bot, None)
+        wait_for_sends(channel_queue_bot.send_scheduler)
+
+    return timed(run, operations)
+
+
+def bench_load_queue(size):
+    handler = make_handler(0)
+    handler.config['queued_posts'] = fill_queue(size)
+    return timed(handler.load_queue, 1)
+
+
+def bench_sort_times(size):
+    # size is the number of post times, capped at one per minute of the day
+    handler = make_handler(0)
+    times = min(size, 24 * 60)
+    handler.config['post_times'] = ['%d:%02d' % ((minute * 7 % 1440) // 60, minute * 7 % 60) for minute in range(times)]
+    handler.start_post_loops()
+
+    def run():
+        for index in range(10):
+            handler.sort_times(100)
+
+    return timed(run, 10)
+
+
+def bench_forecast(size):
+    handler = make_handler(size, per_post=2)
+    handler.config['post_times'] = ['%d:00' % hour for hour in range(0, 24, 2)]
+    handler.start_post_loops()
+    now = time.time()
+
+    def run():
+        for index in range(10):
+            handler.publish_times(now)
+
+    return timed(run, 10)
+
+
+def bench_dump_data(channels, size):
+    updater = FakeUpdater()
+    channel_queue_bot.channel_handlers = {}
+    for index in range(channels):
+        channel_id = -1000 - index
+        channel_queue_bot.channel_handlers[str(channel_id)] = make_handler(size, channel_id=channel_id,
+                                                                           updater=updater)
+    # the first dump serializes everything, later ones only the channels that changed
+    first = timed(lambda: channel_queue_bot.dump_data().wait(), 1)
+    handler = channel_queue_bot.channel_handlers[str(-1000)]
+    handler.add_text(handler.bot, make_update(handler.bot, text='changed'))
+    incremental = timed(lambda: channel_queue_bot.dump_data().wait(), 1)
+    first['incremental_seconds'] = incremental['seconds']
+    first['bytes'] = os.path.getsize(channel_queue_bot.config_writer.path)
+    return first
+
+
+QUEUE_CASES = {
+    'add_text': bench_add_text,
+    'add_media': bench_add_media,
+    'remove_post': bench_remove_post,
+    'shuffle': bench_shuffle,
+    'push_post': bench_push_post,
+    'load_queue': bench_load_queue,
+    'sort_times': bench_sort_times,
+    'forecast': bench_forecast,
+}
+
+
+def reset(directory):
+    channel_queue_bot.config = make_config()
+    channel_queue_bot.config['dedup_dir'] = os.path.join(directory, 'dedup')
+    channel_queue_bot.config['archive_dir'] = os.path.join(directory, 'archive')
+    channel_queue_bot.channel_handlers = {}
+    channel_queue_bot.send_scheduler = SendScheduler(rate=1000000, chat_rate=1000000, chat_burst=1000000)
+    channel_queue_bot.config_writer = ConfigWriter(os.path.join(directory, 'config.json'))
+
+
+def best_of(repeat, directory, func, *args):
+    # keep the fastest of several runs, the slower ones mostly measure noise
+    best = None
+    for index in range(repeat):
+        reset(directory)
+        result = func(*args)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def run(cases, sizes, channel_counts, dump_size, repeat):
+    results = []
+    directory = tempfile.mkdtemp(prefix='queue-bench-')
+    for case in cases:
+        if case == 'dump_data':
+            for channels in channel_counts:
+                result = best_of(repeat, directory, bench_dump_data, channels, dump_size)
+                result.update({'case': case, 'size': dump_size, 'channels': channels})
+                results.append(result)
+                report(result)
+            continue
+        for size in sizes:
+            result = best_of(repeat, directory, QUEUE_CASES[case], size)
+            result.update({'case': case, 'size': size, 'channels': 1})
+            results.append(result)
+            report(result)
+    return results
+
+
+def report(result):
+    sys.stderr.write('%-12s size=%-8d channels=%-5d %10.1f ops/s %10.4fs\n' % (
+        result['case'], result['size'], result['channels'], result['ops_per_second'], result['seconds']))
+
+
+def compare(results, baseline, threshold):
+    # a case regresses when its throughput drops by more than threshold relative to the baseline
+    previous = {(result['case'], result['size'], result['channels']): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['case'], result['size'], result['channels']))
+        if old is None or old['ops_per_second'] == 0:
+            continue
+        change = result['ops_per_second'] / old['ops_per_second'] - 1
+        result['change'] = change
+        if change < -threshold:
+            regressions.append(result)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark queue operations against a fake Bot and JobQueue.')
+    parser.add_argument('--cases', nargs='+', default=list(QUEUE_CASES) + ['dump_data'],
+                        choices=list(QUEUE_CASES) + ['dump_data'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--channels', nargs='+', type=int, default=[1, 10, 100, 1000])
+    parser.add_argument('--dump-size', type=int, default=1000, help='queue size per channel for dump_data')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest is reported')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed throughput drop, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    results = run(args.cases, args.sizes, args.channels, args.dump_size, args.repeat)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+    output = {'python': sys.version.split()[0], 'operations': OPERATIONS, 'results': results,
+              'regressions': regressions}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    for result in regressions:
+        sys.stderr.write('REGRESSION %s size=%d channels=%d: %.0f%% slower\n' % (
+            result['case'], result['size'], result['channels'], -result['change'] * 100))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,41 @@
+import argparse
+import json
+import time
+
+from fakes import FakeUpdater, make_config, wait_for_sends
+
+import channel_instance_handler
+import channel_queue_bot
+from send_scheduler import SendScheduler
+
+MEDIA_TYPES = ('p', 'v', 'a', 'd', 'vo')
+
+
+def run(posts, per_post, latency):
+    channel_queue_bot.config = make_config([-1000], per_post)
+    channel_queue_bot.send_scheduler = SendScheduler(rate=1000000, chat_rate=1000000, chat_burst=1000000)
+    updater = FakeUpdater(latency)
+    handler = channel_instance_handler.ChannelInstanceHandler(updater, -1000, channel_queue_bot.config)
+    handler.config['queued_posts'] = [[index, MEDIA_TYPES[index % len(MEDIA_TYPES)], 'FILE%d' % index, None]
+                                      for index in range(1, posts + 1)]
+    handler.load_queue()
+    updater.bot.calls.clear()
+    slots = posts // per_post
+    start = time.time()
+    for slot in range(slots):
+        handler.push_post(updater.bot, None)
+    wait_for_sends(channel_queue_bot.send_scheduler)
+    elapsed = time.time() - start
+    calls = sum(updater.bot.calls.values())
+    return {'posts': posts, 'per_post': per_post, 'slots': slots, 'api_calls': calls,
+            'calls_per_slot': calls / float(slots), 'calls_by_method': dict(updater.bot.calls),
+            'seconds_per_slot': elapsed / slots}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count Bot API calls made by push_post for queued media posts.')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--per-post', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per Bot API call')
+    args = parser.parse_args()
+    print(json.dumps(run(args.posts, args.per_post, args.latency), indent=2))
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Stub:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeBot:
+    # stands in for telegram.Bot: every method call is counted and answered with a stub object after latency seconds
+    def __init__(self, latency=0):
+        self.id = 1
+        self.token = '1:TOKEN'
+        self.latency = latency
+        self.calls = Counter()
+        self.message_id = 0
+
+    def get_me(self):
+        self.calls['get_me'] += 1
+        return Stub(id=self.id, username='queue_bot', is_bot=True)
+
+    def get_chat(self, chat_id):
+        self.calls['get_chat'] += 1
+        return Stub(id=chat_id, title='Channel %s' % chat_id, type='channel')
+
+    def get_chat_administrators(self, chat_id):
+        self.calls['get_chat_administrators'] += 1
+        return [Stub(user=Stub(id=100, is_bot=False), status='creator'),
+                Stub(user=Stub(id=self.id, is_bot=True), status='administrator')]
+
+    def get_chat_member(self, chat_id, user_id):
+        self.calls['get_chat_member'] += 1
+        return Stub(user=Stub(id=user_id, is_bot=user_id == self.id), status='administrator')
+
+    def get_file(self, file_id):
+        self.calls['get_file'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return Stub(file_id=file_id)
+
+    def __getattr__(self, name):
+        if not name.startswith('send_'):
+            raise AttributeError(name)
+
+        def send(**kwargs):
+            self.calls[name] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            self.message_id += 1
+            return Stub(message_id=self.message_id, chat=Stub(id=kwargs.get('chat_id')))
+
+        return send
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.scheduled = []
+
+    def run_daily(self, callback, time, name=None, **kwargs):
+        self.scheduled.append(Stub(callback=callback, time=time, name=name))
+
+    def run_repeating(self, callback, interval, **kwargs):
+        pass
+
+    def run_once(self, callback, when, **kwargs):
+        pass
+
+    def jobs(self):
+        return self.scheduled
+
+
+class FakeUpdater:
+    def __init__(self, latency=0):
+        self.bot = FakeBot(latency)
+        self.job_queue = FakeJobQueue()
+
+
+class FakeMessage(Stub):
+    def reply_text(self, **kwargs):
+        return self.bot.send_message(chat_id=self.chat_id, **kwargs)
+
+
+def make_update(bot, user_id=100, text=None, photo=None, caption=None, media_group_id=None, message_id=1):
+    message = FakeMessage(bot=bot, chat_id=user_id, from_user=Stub(id=user_id), message_id=message_id, text=text,
+                          text_markdown=text, caption=caption, photo=[], video=None, audio=None, document=None,
+                          sticker=None, voice=None, video_note=None, media_group_id=media_group_id,
+                          forward_from_chat=None)
+    if photo is not None:
+        message.photo = [Stub(file_id=photo + '_small'), Stub(file_id=photo)]
+    return Stub(message=message, callback_query=None, effective_user=message.from_user)
+
+
+def make_callback_update(bot, data, user_id=100):
+    query = Stub(data=data, from_user=Stub(id=user_id), message=Stub(chat_id=user_id, message_id=1),
+                 edit_message_text=lambda **kwargs: None, answer=lambda **kwargs: None)
+    return Stub(message=None, callback_query=query, effective_user=query.from_user)
+
+
+def make_config(channel_ids=(), per_post=1):
+    default_settings = {'notify_queue_empty': True, 'admins': [], 'queued_posts': [], 'notify_low': True,
+                        'per_post': per_post, 'notify_low_count': 10, 'disable_notifications': False,
+                        'post_times': [], 'file_ids': {}}
+    config = {'channels': {}, 'timezone_prefs': {}, 'focus_channels': {}, 'admins': [100], 'token': '1:TOKEN',
+              'waiting_for_channel_setup': [], 'waiting_for_channel_select': [], 'timezones': ['+0'],
+              'default_settings': default_settings, 'dedup_dir': None,
+              'archive_dir': None}
+    for channel_id in channel_ids:
+        config['channels'][str(channel_id)] = dict(default_settings, queued_posts=[], post_times=[])
+    return config
+
+
+def wait_for_sends(scheduler, timeout=60):
+    deadline = time.time() + timeout
+    while scheduler.backlog() > 0 and time.time() < deadline:
+        time.sleep(0.001)
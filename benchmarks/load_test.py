@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from fakes import make_config
+from stub_bot_api import StubBotApi, user
+
+from telegram.ext import Updater
+
+import channel_queue_bot
+from config_writer import ConfigWriter
+from send_scheduler import SendScheduler
+
+TOKEN = '123456:LOADTEST'
+
+
+def private_chat(user_id):
+    return {'id': user_id, 'type': 'private', 'first_name': 'User %d' % user_id}
+
+
+def message_update(user_id, message_id, text=None, photo=None):
+    message = {'message_id': message_id, 'date': int(time.time()), 'chat': private_chat(user_id),
+               'from': user(user_id)}
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])}]
+    if photo is not None:
+        message['photo'] = [{'file_id': photo, 'width': 320, 'height': 320}]
+    return {'message': message}
+
+
+def callback_update(user_id, data):
+    return {'callback_query': {'id': str(time.time()), 'from': user(user_id), 'chat_instance': str(user_id),
+                               'data': data, 'message': {'message_id': 1, 'date': int(time.time()),
+                                                         'chat': private_chat(user_id)}}}
+
+
+def forwards(admins, channel_ids, count):
+    # every admin bulk-forwards count photos into their focus channel
+    for index in range(count):
+        for admin_id in admins:
+            yield message_update(admin_id, index + 1, photo='PHOTO_%d_%d' % (admin_id, index))
+
+
+def addtime_burst(admins, channel_ids, count):
+    for index in range(count):
+        for admin_id in admins:
+            minute = (index * len(admins) + admin_id) % (24 * 60)
+            yield message_update(admin_id, index + 1, text='/addtime %d:%02d' % (minute // 60, minute % 60))
+
+
+def remove_storm(admins, channel_ids, count):
+    for index in range(count):
+        for (position, admin_id) in enumerate(admins):
+            channel_id = channel_ids[position % len(channel_ids)]
+            yield callback_update(admin_id, 'remove[&sp?]%d[&sp?]%d' % (channel_id, index + 1))
+
+
+SCENARIOS = {'forwards': forwards, 'addtime': addtime_burst, 'remove': remove_storm}
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentiles(values):
+    values = sorted(values)
+    if len(values) == 0:
+        return {'count': 0}
+    return {'count': len(values), 'p50': values[len(values) // 2], 'p90': values[int(len(values) * 0.9)],
+            'p99': values[int(len(values) * 0.99)], 'max': values[-1]}
+
+
+def response_latencies(api, injected):
+    # pair the n-th update sent from a chat with the n-th call the bot made to that chat
+    responses = {}
+    for (sent_at, method, chat_id) in api.sends:
+        responses.setdefault(chat_id, []).append(sent_at)
+    latencies = []
+    for (chat_id, times) in injected.items():
+        for (injected_at, responded_at) in zip(times, responses.get(chat_id, [])):
+            latencies.append(responded_at - injected_at)
+    return latencies
+
+
+def start_bot(api, channel_ids, admins, queue_size, post_time, workers):
+    config = make_config(channel_ids)
+    config['token'] = TOKEN
+    for (index, channel_id) in enumerate(channel_ids):
+        channel = config['channels'][str(channel_id)]
+        channel['queued_posts'] = [[post_id, 'p', 'FILE_%d_%d' % (channel_id, post_id), None]
+                                   for post_id in range(1, queue_size + 1)]
+        if post_time is not None:
+            channel['post_times'] = [post_time]
+    for (index, admin_id) in enumerate(admins):
+        config['focus_channels'][str(admin_id)] = channel_ids[index % len(channel_ids)]
+    channel_queue_bot.config = config
+    channel_queue_bot.channel_handlers = {}
+    channel_queue_bot.config_writer = ConfigWriter(os.path.join(tempfile.mkdtemp(prefix='queue-load-'),
+                                                                'config.json'))
+    channel_queue_bot.send_scheduler = SendScheduler()
+    channel_queue_bot.updater = Updater(TOKEN, base_url=api.base_url, workers=workers)
+    channel_queue_bot.register_channel_handlers(channel_queue_bot.all_channel_ids())
+    deadline = time.time() + 300
+    while len(channel_queue_bot.channel_handlers) < len(channel_ids) and time.time() < deadline:
+        time.sleep(0.05)
+    channel_queue_bot.register_handlers(channel_queue_bot.updater.dispatcher)
+    channel_queue_bot.updater.start_polling(poll_interval=0, timeout=1)
+    return channel_queue_bot.updater
+
+
+def wait_idle(api, timeout):
+    # wait until the bot has stopped making calls for a second, or the timeout passes
+    deadline = time.time() + timeout
+    last = -1
+    while time.time() < deadline:
+        total = sum(api.calls.values())
+        if total == last and channel_queue_bot.send_scheduler.backlog() == 0:
+            return
+        last = total
+        time.sleep(1)
+
+
+def run(args):
+    admins = list(range(100, 100 + args.admins))
+    api = StubBotApi(latency=args.latency, admins=admins)
+    api.start()
+    channel_ids = [-1000000000 - index for index in range(args.channels)]
+    for channel_id in channel_ids:
+        api.add_channel(channel_id, 'Load Channel %d' % channel_id)
+
+    post_time = None
+    slot_time = None
+    if args.slots:
+        # every channel posts at the start of the next minute that leaves time to boot
+        slot_time = (time.time() // 60 + 2) * 60
+        post_time = time.strftime('%H:%M', time.gmtime(slot_time)).lstrip('0')
+        if post_time.startswith(':'):
+            post_time = '0' + post_time
+    start = time.time()
+    updater = start_bot(api, channel_ids, admins, args.queue_size, post_time, args.workers)
+    ready = time.time() - start
+
+    if args.trace:
+        updates = read_trace(args.trace)
+    else:
+        updates = list(SCENARIOS[args.scenario](admins, channel_ids, args.count))
+    calls_before = sum(api.calls.values()) - api.calls['getUpdates']
+    inject_start = time.time()
+    injected = {}
+    for update in updates:
+        chat_id = (update.get('message') or update.get('callback_query', {}).get('message', {}))['chat']['id']
+        injected.setdefault(chat_id, []).append(time.time())
+        api.inject(update)
+        if args.rate:
+            time.sleep(1.0 / args.rate)
+    if slot_time is not None:
+        time.sleep(max(0, slot_time - time.time()))
+    wait_idle(api, args.timeout)
+    elapsed = time.time() - inject_start
+    updater.stop()
+    api.stop()
+
+    calls = sum(api.calls.values()) - api.calls['getUpdates'] - calls_before
+    channel_sends = [sent_at for (sent_at, method, chat_id) in api.sends if chat_id in channel_ids]
+    result = {
+        'scenario': 'trace' if args.trace else args.scenario,
+        'channels': args.channels,
+        'admins': args.admins,
+        'updates': len(updates),
+        'startup_seconds': ready,
+        'inbound_latency': percentiles(response_latencies(api, injected)),
+        'outbound_calls': calls,
+        'outbound_calls_per_second': calls / elapsed if elapsed else 0,
+        'calls_by_method': dict(api.calls),
+        'flood_errors': api.flood_errors,
+    }
+    if slot_time is not None:
+        result['slot_lateness'] = percentiles([sent_at - slot_time for sent_at in channel_sends])
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay update streams through the bot against a local stub '
+                                                 'Bot API server and report latency, throughput and flood errors.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='forwards')
+    parser.add_argument('--trace', help='replay recorded updates (one JSON object per line) instead of a scenario')
+    parser.add_argument('--count', type=int, default=100, help='updates per admin for the scenario')
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--admins', type=int, default=10)
+    parser.add_argument('--queue-size', type=int, default=100, help='posts queued per channel at startup')
+    parser.add_argument('--slots', action='store_true',
+                        help='have every channel post in the same minute and report slot lateness')
+    parser.add_argument('--rate', type=float, default=0, help='updates injected per second, 0 for one burst')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated Bot API latency in seconds')
+    parser.add_argument('--workers', type=int, default=4, help='dispatcher worker threads')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+    json.dump(run(args), sys.stdout, indent=2)
+    sys.stdout.write('\n')
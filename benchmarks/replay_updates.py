@@ -0,0 +1,52 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def read_updates(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def post_update(url, secret_token, update):
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers[SECRET_HEADER] = secret_token
+    request = Request(url, data=json.dumps(update).encode('utf-8'), headers=headers, method='POST')
+    start = time.time()
+    try:
+        with urlopen(request) as response:
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    return status, time.time() - start
+
+
+def replay(url, updates, secret_token=None, concurrency=1):
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda update: post_update(url, secret_token, update), updates))
+    elapsed = time.time() - start
+    statuses = {}
+    for (status, _) in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    latencies = sorted(latency for (_, latency) in results)
+    return {'updates': len(updates), 'seconds': elapsed, 'updates_per_second': len(updates) / elapsed,
+            'statuses': statuses, 'p50': latencies[len(latencies) // 2] if latencies else 0,
+            'max': latencies[-1] if latencies else 0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='POST recorded Telegram updates (one JSON object per line) to a '
+                                                 'webhook, the way Telegram delivers them.')
+    parser.add_argument('updates', help='file with one update per line')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/')
+    parser.add_argument('--secret-token')
+    parser.add_argument('--concurrency', type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(replay(args.url, read_updates(args.updates), args.secret_token, args.concurrency), indent=2))
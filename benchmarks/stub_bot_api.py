@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+
+BOT_ID = 1
+ADMIN_ID = 100
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.handle_call()
+
+    def do_GET(self):
+        self.handle_call()
+
+    def handle_call(self):
+        api = self.server.api
+        method = self.path.rstrip('/').split('/')[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if self.headers.get('Content-Type', '').startswith('application/json') and body:
+            params = json.loads(body)
+        else:
+            params = dict(parse_qsl(body))
+        (status, payload) = api.call(method, params)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# In-process stand-in for the Telegram Bot API. Updates pushed with inject() are served through getUpdates,
+# every call is counted and timestamped, and flood limits are enforced the way Telegram does with 429s.
+class StubBotApi:
+    def __init__(self, port=0, latency=0, global_limit=30, chat_limit=3, admins=(ADMIN_ID,)):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.admins = list(admins)
+        self.condition = threading.Condition()
+        self.updates = []
+        self.next_update_id = 1
+        self.calls = Counter()
+        self.sends = []
+        self.recent = deque()
+        self.recent_by_chat = defaultdict(deque)
+        self.flood_errors = 0
+        self.message_id = 0
+        self.chats = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StubRequestHandler)
+        self.server.api = self
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d/bot' % self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='stub-bot-api', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_channel(self, channel_id, title):
+        self.chats[channel_id] = {'id': channel_id, 'type': 'channel', 'title': title}
+
+    def inject(self, update):
+        with self.condition:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.condition.notify_all()
+        return update['update_id']
+
+    def call(self, method, params):
+        with self.condition:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': user(BOT_ID, True)}
+        if method == 'getChat':
+            return 200, {'ok': True, 'result': self.chat(params['chat_id'])}
+        if method == 'getChatAdministrators':
+            admins = [{'user': user(admin_id), 'status': 'administrator'} for admin_id in self.admins]
+            admins[0]['status'] = 'creator'
+            return 200, {'ok': True, 'result': admins + [{'user': user(BOT_ID, True), 'status': 'administrator'}]}
+        if method == 'getChatMember':
+            return 200, {'ok': True, 'result': {'user': user(int(params['user_id'])), 'status': 'administrator'}}
+        if method in ('deleteWebhook', 'setWebhook', 'answerCallbackQuery'):
+            return 200, {'ok': True, 'result': True}
+        if method.startswith('send') or method.startswith('edit'):
+            return self.send(method, params)
+        return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method %s' % method}
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.time() + timeout
+        with self.condition:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while len(self.updates) == 0 and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return self.updates[:int(params.get('limit') or 100)]
+
+    def send(self, method, params):
+        now = time.time()
+        chat_id = int(params.get('chat_id') or 0)
+        with self.condition:
+            for window in [self.recent] + [self.recent_by_chat[chat_id]]:
+                while len(window) > 0 and window[0] <= now - 1:
+                    window.popleft()
+            if len(self.recent) >= self.global_limit or len(self.recent_by_chat[chat_id]) >= self.chat_limit:
+                self.flood_errors += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                             'parameters': {'retry_after': 1}}
+            self.recent.append(now)
+            self.recent_by_chat[chat_id].append(now)
+            self.message_id += 1
+            self.sends.append((now, method, chat_id))
+            message = {'message_id': self.message_id, 'date': int(now), 'chat': self.chat(chat_id)}
+        if method == 'editMessageText':
+            message['text'] = params.get('text')
+        return 200, {'ok': True, 'result': message}
+
+    def chat(self, chat_id):
+        chat_id = int(chat_id)
+        if chat_id in self.chats:
+            return self.chats[chat_id]
+        return {'id': chat_id, 'type': 'private', 'first_name': 'User %d' % chat_id}
+
+
+def user(user_id, is_bot=False):
+    return {'id': user_id, 'is_bot': is_bot, 'first_name': 'User %d' % user_id, 'username': 'user%d' % user_id}
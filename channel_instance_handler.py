@@ -1,32 +1,100 @@
-import datetime
-from random import shuffle
-from telegram import TelegramError, InlineKeyboardMarkup, InlineKeyboardButton
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+from telegram import TelegramError, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
+from telegram.error import RetryAfter
 
 import channel_queue_bot
+import shuffle_engine
+from dedup_index import DedupIndex, PublishedHistory, media_digest, text_digest
+from post_archive import DAY, PostArchive, day_string
+import timezones
+from post_queue import QueuedPost, PostQueue
+from post_scheduler import ScheduleIndex, to_minutes, to_time_string
+from send_scheduler import PRIORITY_POST, PRIORITY_NOTICE
+
+MEDIA_TYPES = (('photo', 'p'), ('video', 'v'), ('audio', 'a'), ('document', 'd'), ('sticker', 's'), ('voice', 'vo'),
+               ('video_note', 'vn'))
+SEND_METHODS = {'p': ('send_photo', 'photo'), 'v': ('send_video', 'video'), 'a': ('send_audio', 'audio'),
+                'd': ('send_document', 'document'), 's': ('send_sticker', 'sticker'), 'vo': ('send_voice', 'voice'),
+                'vn': ('send_video_note', 'video_note')}
+TYPE_NAMES = {'t': 'Text', 'p': 'Photo', 'v': 'Video', 'a': 'Audio', 'd': 'Document', 's': 'Sticker', 'vo': 'Voice',
+              'vn': 'Video note'}
+# post types a media group can hold, and Telegram's limit on its size
+ALBUM_TYPES = {'p': InputMediaPhoto, 'v': InputMediaVideo}
+ALBUM_SIZE = 10
+BULK_PAGE_SIZE = 8
+FORECAST_POSTS = 10
+DUPLICATES_KEPT = 100
+BULK_BATCHES_KEPT = 50
+
+
+def strip_markdown(text):
+    # excerpts of queued texts can cut Markdown entities in half, drop the markup characters instead
+    for character in '*_`[':
+        text = text.replace(character, '')
+    return text
 
 
 class ChannelInstanceHandler:
-    def __init__(self, updater, channel_id, g_config):
+    def __init__(self, updater, channel_id, g_config, store=None, bot_id=None):
         self.updater = updater
         self.bot = self.updater.bot
         self.channel_id = int(channel_id)
         self.g_config = g_config
-        self.connect_channel()
-        self.start_post_loops()
+        self.store = store
+        self.dirty = True
         self.logger = channel_queue_bot.logger
+        # confirmations for posts added in bulk or in quick succession are collected per user and sent as one summary
+        self.bulk_lock = threading.Lock()
+        self.bulk_users = set()
+        self.pending = {}
+        self.skipped = {}
+        self.last_added = {}
+        self.batches = OrderedDict()
+        self.next_batch_id = 1
+        # duplicates an admin may still choose to queue anyway, by token
+        self.duplicates = OrderedDict()
+        self.next_duplicate_id = 1
+        if bot_id is None:
+            bot_id = self.bot.get_me().id
+        self.connect_channel(bot_id)
+        self.start_post_loops()
 
-    def connect_channel(self):
-        self.chat = self.bot.get_chat(chat_id=self.channel_id)
-        if str(self.channel_id) not in self.g_config['channels']:
+    def connect_channel(self, bot_id):
+        # a (re)connect looks the channel up again rather than trusting what was cached before
+        channel_queue_bot.chat_cache.invalidate(self.channel_id)
+        stored = self.store is not None and self.store.has_channel(self.channel_id)
+        if stored:
+            self.config = self.store.load_channel(self.channel_id)
+        elif str(self.channel_id) not in self.g_config['channels']:
             self.config = {}
         else:
-            self.config = self.g_config['channels'][str(self.channel_id)]
+            # set up on a copy, the dump job may be copying the entry while channels connect
+            self.config = {key: copy.copy(value)
+                           for (key, value) in self.g_config['channels'][str(self.channel_id)].items()}
+        owner = self.config.get('bot_id')
+        if owner is not None and owner != bot_id and owner in channel_queue_bot.updaters:
+            # channels set up through another hosted token are run by that bot
+            self.updater = channel_queue_bot.updaters[owner]
+            self.bot = self.updater.bot
+            bot_id = owner
+        self.chat = channel_queue_bot.chat_cache.get_chat(self.bot, self.channel_id)
         self.assure_defaults()
+        self.dedup = DedupIndex(self.open_history())
+        self.archive = None
+        if self.g_config.get('archive_dir', 'archive') is not None:
+            self.archive = PostArchive(os.path.join(self.data_directory(), self.g_config.get('archive_dir', 'archive'),
+                                                    str(self.channel_id)))
         self.load_queue()
+        if self.store is not None and not stored:
+            self.store.import_channel(self.channel_id, self.config, self.queue)
         self.update_admins()
-        self.bot_name = "%s Queue Bot" % self.chat.title
-        if self.chat.get_member(self.bot.get_me().id) is None:
+        if channel_queue_bot.chat_cache.get_member(self.bot, self.channel_id, bot_id) is None:
             self.logger.warning("Not a member of %s" % self.chat.title)
+        self.g_config['channels'][str(self.channel_id)] = self.config
 
     def assure_defaults(self):
         for key in self.g_config['default_settings']:
@@ -39,96 +107,282 @@ class ChannelInstanceHandler:
                     self.config[key] = self.g_config['default_settings'][key]
 
     def update_admins(self):
-        self.config['admins'] = []
-        for admin in self.chat.get_administrators():
-            if not admin.user.is_bot:
-                self.config['admins'].append(admin.user.id)
+        # looked up again with the admins, so a renamed channel shows its new title after the periodic refresh
+        self.chat = channel_queue_bot.chat_cache.get_chat(self.bot, self.channel_id)
+        self.bot_name = "%s Queue Bot" % self.chat.title
+        admins = channel_queue_bot.chat_cache.admin_ids(self.bot, self.channel_id, refresh=True)
+        if admins != self.config.get('admins'):
+            self.config['admins'] = admins
+            self.persist('save_settings', self.config)
 
     def load_queue(self):
-        self.queue = []
-        self.current_index = 0
-        self.reference_index = -1
-        max_index = -1
         read_queue = self.config['queued_posts']
-        for message_data in read_queue:
-            index = int(message_data.split(':')[0])
-            if self.reference_index == -1:
-                self.reference_index = index
-            else:
-                self.reference_index = min(self.reference_index, index)
-                max_index = max(max_index, index)
+        posts = [QueuedPost.from_data(data) for data in read_queue]
+        if any(isinstance(data, str) for data in read_queue):
+            posts.sort(key=lambda post: post.id)
+        self.queue = PostQueue(posts)
+        self.dedup.rebuild(self.queue)
 
-        self.queue = ["null"] * (max_index - self.reference_index + 1)
-        for message_data in read_queue:
-            index = int(message_data.split(':')[0])
-            self.queue[index - self.reference_index] = message_data
-        self.queue[:] = [x for x in self.queue if x != "null"]
+    def data_directory(self):
+        return os.path.dirname(os.path.abspath(channel_queue_bot.__file__))
+
+    def open_history(self):
+        directory = self.g_config.get('dedup_dir', 'dedup')
+        if directory is None:
+            return None
+        path = os.path.join(self.data_directory(), directory, '%d.json' % self.channel_id)
+        return PublishedHistory(path, self.g_config.get('dedup_window_days', 30),
+                                self.g_config.get('dedup_windows', 6), self.g_config.get('dedup_window_capacity', 5000))
 
     def start_post_loops(self):
-        times = self.config['post_times']
-        for time_string in times:
-            args = time_string.split(':')
-            hours = int(args[0])
-            minutes = int(args[1])
-            time = datetime.time(hours, minutes)
-            name = str(self.chat.id) + time_string
-            self.updater.job_queue.run_daily(self.push_post, time, name=name)
-
-    def shuffle(self, bot, update):
-        # strip numbers from queue
-        numberless = []
-        for entry in self.queue:
-            numberless.append(entry[entry.find(':'):])
-
-        # shuffle new queue
-        shuffle(numberless)
-
-        # add renumber entries
-        for index in range(0, len(numberless)):
-            numberless[index] = str(index) + numberless[index]
-
-        # set new queue as official queue
-        self.queue = numberless
+        self.schedule = ScheduleIndex(to_minutes(time_string) for time_string in self.config['post_times'])
+        for minute in self.schedule:
+            channel_queue_bot.post_scheduler.add(self, minute)
+
+    def shuffle(self, bot, update, args=()):
+        mode = self.config.get('shuffle_mode', 'uniform')
+        if len(args) > 0:
+            if args[0] not in shuffle_engine.MODES:
+                bot.send_message(chat_id=update.message.chat_id,
+                                 text="Use `/shuffle`, `/shuffle type` to keep posts of one type apart or "
+                                      "`/shuffle admin` to mix posts from different admins.", parse_mode='Markdown')
+                return
+            mode = args[0]
+        # posts of a forwarded album are shuffled as one unit so they stay together
+        units = []
+        for post in self.queue:
+            if post.group is not None and len(units) > 0 and units[-1][0].group == post.group:
+                units[-1].append(post)
+            else:
+                units.append([post])
+        shuffle_engine.shuffle(units, mode, self.config.get('shuffle_max_run', 2))
+        posts = self.queue.reorder([post for unit in units for post in unit])
+        self.persist('reorder', posts)
 
     def add_text(self, bot, update):
-        if len(self.queue) == 0:
-            next_index = 1
-        else:
-            next_index = int(self.queue[-1].split(":")[0]) + 1
         text = update.message.text_markdown
-        text = text.replace(':', '&cl')
-        data_text = "%d:t:%s" % (next_index, text)
-        self.queue.append(data_text)
-        self.post_queued_message(bot, update, next_index)
+        post = QueuedPost(self.queue.next_id, 't', text, admin=update.message.from_user.id, digest=text_digest(text))
+        if self.is_duplicate(bot, update, post):
+            return
+        self.enqueue(post)
+        self.confirm_post(bot, update, post.id)
 
     def add_media(self, bot, update):
         message = update.message
-        type = None
-        if message.photo is not None:
-            type = "p"
-        elif message.video is not None:
-            type = "v"
-        elif message.audio is not None:
-            type = "a"
-        elif message.document is not None:
-            type = "d"
-        elif message.sticker is not None:
-            type = "s"
-        elif message.voice is not None:
-            type = "vo"
-        else:
-            type = "vn"
-        if len(self.queue) == 0:
-            next_index = 1
+        for (attribute, type) in MEDIA_TYPES:
+            media = getattr(message, attribute)
+            if media:
+                break
+        if isinstance(media, list):
+            media = media[-1]
+        post = QueuedPost(self.queue.next_id, type, media.file_id, message.caption, message.media_group_id,
+                          message.from_user.id, media_digest(media))
+        if self.is_duplicate(bot, update, post):
+            return
+        self.enqueue(post)
+        self.confirm_post(bot, update, post.id)
+
+    def enqueue(self, post):
+        self.queue.append(post)
+        self.dedup.add(post)
+        self.persist('add_post', post)
+
+    def is_duplicate(self, bot, update, post):
+        if not self.config.get('dedup', True):
+            return False
+        found = self.dedup.find(post.digest)
+        if found is None:
+            return False
+        message = update.message
+        user_id = message.chat_id
+        with self.bulk_lock:
+            token = self.next_duplicate_id
+            self.next_duplicate_id += 1
+            self.duplicates[token] = (post, found)
+            while len(self.duplicates) > DUPLICATES_KEPT:
+                self.duplicates.popitem(last=False)
+            batched = self.batching(message)
+            if batched:
+                self.skipped.setdefault(user_id, []).append(token)
+        if not batched:
+            self.send_duplicates(user_id, [token], message.message_id)
+        return True
+
+    def send_duplicates(self, user_id, tokens, reply_to=None):
+        found = [(token,) + self.duplicates[token] for token in tokens if token in self.duplicates]
+        if len(found) == 0:
+            return False
+        # one pass over the queue for all duplicates, albums count as one post like when they are published
+        posts = list(self.queue)
+        times = self.publish_times(time.time(), posts) if len(self.schedule) > 0 else None
+        positions = {post.id: position for (position, post) in enumerate(posts)}
+        days = self.g_config.get('dedup_window_days', 30) * self.g_config.get('dedup_windows', 6)
+        lines = []
+        for (token, post, (kind, post_id)) in found[:BULK_PAGE_SIZE]:
+            if kind == 'queued' and post_id in positions:
+                line = "queued at position %d" % (positions[post_id] + 1)
+                if times is not None:
+                    line += ", going out *%s*" % self.to_pref_datetime(user_id, times[positions[post_id]])
+            elif kind == 'queued':
+                line = "queued already"
+            else:
+                line = "most likely published within the last %d days" % days
+            lines.append(line)
+        if len(found) == 1:
+            text = "This post is a duplicate for *%s*: %s." % (self.chat.title, lines[0])
+            keyboard = [[InlineKeyboardButton("Queue anyway", callback_data="dup_add[&sp?]%s[&sp?]%d" % (
+                self.chat.id, found[0][0]))]]
         else:
-            next_index = int(self.queue[-1].split(":")[0]) + 1
-        file_id = message.photo[-1].file_id
-        caption = message.caption
-        data_text = "%d:%s:%s" % (next_index, type, file_id)
-        if caption is not None:
-            data_text += ":%s" % message.caption.replace(':', '&cl')
-        self.queue.append(data_text)
-        self.post_queued_message(bot, update, next_index)
+            text = "I've skipped *%d* duplicate posts for *%s*:" % (len(found), self.chat.title)
+            keyboard = []
+            for (index, line) in enumerate(lines):
+                post = found[index][1]
+                label = strip_markdown(self.describe(post)) if post.type == 't' else TYPE_NAMES[post.type]
+                text += "\n%d. %s: %s" % (index + 1, label, line)
+                keyboard.append([InlineKeyboardButton("Queue %d anyway" % (index + 1),
+                                                      callback_data="dup_add[&sp?]%s[&sp?]%d" % (self.chat.id,
+                                                                                                found[index][0]))])
+            if len(found) > len(lines):
+                text += "\n...and %d more." % (len(found) - len(lines))
+        self.send(self.bot.send_message, user_id, PRIORITY_NOTICE, text=text,
+                  reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', reply_to_message_id=reply_to)
+        return True
+
+    def add_duplicate(self, bot, update, token):
+        query = update.callback_query
+        duplicate = self.duplicates.pop(token, None)
+        if duplicate is None:
+            query.edit_message_text(text="This post can't be queued from here anymore, send it to me again.",
+                                    reply_markup=None)
+            query.answer()
+            return
+        post = duplicate[0]
+        post.id = self.queue.next_id
+        self.enqueue(post)
+        keyboard = [[InlineKeyboardButton("Remove", callback_data="remove[&sp?]%s[&sp?]%d" % (self.chat.id, post.id))]]
+        query.edit_message_text(text="Ok, I've added the duplicate to the queue for *%s* anyway." % self.chat.title,
+                                reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        query.answer()
+
+    def confirm_post(self, bot, update, post_id):
+        with self.bulk_lock:
+            batched = self.batching(update.message)
+            if batched:
+                self.pending[update.message.chat_id].append(post_id)
+        if not batched:
+            self.post_queued_message(bot, update, post_id)
+
+    def batching(self, message):
+        # called with bulk_lock held: whether the reply to message is collected into the user's next summary.
+        # A lone post is answered right away, albums, /bulk and bursts of forwards are summarized
+        user_id = message.chat_id
+        now = time.time()
+        delay = self.g_config.get('bulk_delay', 2)
+        last_added = self.last_added.get(user_id, 0)
+        self.last_added[user_id] = now
+        if user_id in self.pending:
+            return True
+        if user_id not in self.bulk_users and message.media_group_id is None and now - last_added > delay:
+            return False
+        self.pending[user_id] = []
+        self.updater.job_queue.run_once(self.flush_pending, delay, context=user_id)
+        return True
+
+    def start_bulk(self, bot, update):
+        user_id = update.message.chat_id
+        with self.bulk_lock:
+            self.bulk_users.add(user_id)
+            self.pending.setdefault(user_id, [])
+        bot.send_message(chat_id=user_id,
+                         text="Bulk mode is on. Send or forward all posts for *%s* and use /done when you're finished."
+                              % self.chat.title, parse_mode='Markdown')
+
+    def finish_bulk(self, bot, update):
+        user_id = update.message.chat_id
+        with self.bulk_lock:
+            if user_id not in self.bulk_users:
+                bot.send_message(chat_id=user_id, text="Bulk mode isn't on. Use /bulk to start it.")
+                return
+            self.bulk_users.discard(user_id)
+        if not self.send_summary(user_id):
+            bot.send_message(chat_id=user_id, text="Bulk mode is off. No posts were added.")
+
+    def flush_pending(self, bot, job):
+        user_id = job.context
+        with self.bulk_lock:
+            if user_id in self.bulk_users:
+                return
+            remaining = self.last_added.get(user_id, 0) + self.g_config.get('bulk_delay', 2) - time.time()
+            if remaining > 0:
+                # still receiving posts, check again once the burst has been quiet for bulk_delay
+                self.updater.job_queue.run_once(self.flush_pending, remaining, context=user_id)
+                return
+        self.send_summary(user_id)
+
+    def send_summary(self, user_id):
+        with self.bulk_lock:
+            post_ids = self.pending.pop(user_id, [])
+            tokens = self.skipped.pop(user_id, [])
+            if len(post_ids) > 0:
+                batch_id = self.next_batch_id
+                self.next_batch_id += 1
+                self.batches[batch_id] = post_ids
+                while len(self.batches) > BULK_BATCHES_KEPT:
+                    self.batches.popitem(last=False)
+        if len(post_ids) > 0:
+            (text, markup) = self.render_batch(batch_id, 0)
+            self.send(self.bot.send_message, user_id, PRIORITY_NOTICE, text=text, reply_markup=markup,
+                      parse_mode='Markdown')
+        return self.send_duplicates(user_id, tokens) or len(post_ids) > 0
+
+    def render_batch(self, batch_id, page):
+        post_ids = self.batches[batch_id]
+        queued = [self.queue.get(post_id) for post_id in post_ids if post_id in self.queue]
+        text = "Success! I've added *%d* %s to the queue for *%s*!" % (
+            len(post_ids), "post" if len(post_ids) == 1 else "posts", self.chat.title)
+        if len(queued) < len(post_ids):
+            text += " %d of them are still queued." % len(queued)
+        pages = max(1, (len(queued) + BULK_PAGE_SIZE - 1) // BULK_PAGE_SIZE)
+        page = min(page, pages - 1)
+        keyboard = []
+        for post in queued[page * BULK_PAGE_SIZE:(page + 1) * BULK_PAGE_SIZE]:
+            data = "bulk_rm[&sp?]%s[&sp?]%d[&sp?]%d[&sp?]%d" % (self.chat.id, batch_id, page, post.id)
+            keyboard.append([InlineKeyboardButton("Remove %s" % self.describe(post), callback_data=data)])
+        if pages > 1:
+            text += "\n\nPage %d of %d." % (page + 1, pages)
+            data = "bulk_page[&sp?]%s[&sp?]%d[&sp?]%d"
+            (previous, following) = ((page - 1) % pages, (page + 1) % pages)
+            keyboard.append([InlineKeyboardButton("⬅", callback_data=data % (self.chat.id, batch_id, previous)),
+                             InlineKeyboardButton("➡", callback_data=data % (self.chat.id, batch_id, following))])
+        return text, InlineKeyboardMarkup(keyboard)
+
+    def describe(self, post):
+        if post.type == 't':
+            text = post.payload.replace('\n', ' ')
+            if len(text) > 24:
+                text = text[:23] + '…'
+            return '"%s"' % text
+        return "%s #%d" % (TYPE_NAMES[post.type], post.id)
+
+    def bulk_page(self, bot, update, batch_id, page, post_id=None):
+        query = update.callback_query
+        if batch_id not in self.batches:
+            query.edit_message_text(text="This list has expired. Use /queue to check the queue for *%s*."
+                                         % self.chat.title, reply_markup=None, parse_mode='Markdown')
+            query.answer()
+            return
+        answer = None
+        if post_id is not None:
+            post = self.queue.remove(post_id)
+            if post is None:
+                answer = "That post is no longer in the queue."
+            else:
+                self.dedup.discard(post)
+                self.persist('remove_post', post_id)
+                answer = "Removed."
+        (text, markup) = self.render_batch(batch_id, page)
+        query.edit_message_text(text=text, reply_markup=markup, parse_mode='Markdown')
+        query.answer(text=answer)
 
     def post_queued_message(self, bot, update, post_id):
         post = update.message
@@ -139,13 +393,19 @@ class ChannelInstanceHandler:
 
     def remove_post(self, bot, update, post_id):
         query = update.callback_query
-        reply = "I couldn't find this post in the queue for *%s*." % self.chat.title
-        for post_data in self.queue:
-            if int(post_data.split(':')[0]) == post_id:
-                self.queue.remove(post_data)
-                reply = "This post has been removed from the queue for *%s*." % self.chat.title
+        post = self.queue.remove(post_id)
+        if post is None:
+            reply = "I couldn't find this post in the queue for *%s*." % self.chat.title
+        else:
+            self.dedup.discard(post)
+            self.persist('remove_post', post_id)
+            reply = "This post has been removed from the queue for *%s*." % self.chat.title
         query.edit_message_text(text=reply, reply_markup=None, parse_mode='Markdown')
 
+    def queue_status(self, bot, update):
+        bot.send_message(chat_id=update.message.chat_id, text="There are currently *%d* posts queued for *%s*" % (
+            len(self.queue), self.chat.title), parse_mode='Markdown')
+
     def times(self, bot, update):
         if len(self.config['post_times']) == 0:
             bot.send_message(chat_id=update.message.chat_id,
@@ -165,32 +425,54 @@ class ChannelInstanceHandler:
         bot.send_message(chat_id=update.message.chat_id, text=text, parse_mode='Markdown')
 
     def sort_times(self, user_id):
-        # total number of times
-        times_count = len(self.config['post_times'])
-        # create a copy of times in user preferred time
-        times = []
-        for time in self.config['post_times']:
-            times.append(self.to_pref_time(user_id, time))
-        for index in range(0, times_count):
-            (min_index, minimum) = (index, times[index].split(':'))
-            for search_index in range(index, times_count):
-                contender = times[search_index].split(':')
-                if minimum == contender:
-                    continue
-                if int(minimum[0]) == int(contender[0]):
-                    digit = 1
-                else:
-                    digit = 0
-                winner_num = min(int(minimum[digit]), int(contender[digit]))
-                if int(contender[digit]) == winner_num:
-                    winner = contender
-                    (min_index, minimum) = (search_index, times[search_index].split(':'))
-                else:
-                    continue
-            temp = times[index]
-            times[index] = times[min_index]
-            times[min_index] = temp
-        return times
+        (pref, now) = (self.timezone_pref(user_id), time.time())
+        return [to_time_string(minute) for minute in
+                sorted(timezones.to_local_minute(pref, minute, now) for minute in self.schedule)]
+
+    def publish_times(self, now, posts=None):
+        # publish time of every queued post in queue order, a forwarded album counts as one post with group_media
+        if posts is None:
+            posts = list(self.queue)
+        per_post = self.config['per_post']
+        if not self.config.get('group_media', False):
+            slots = self.schedule.slot_times(now, (len(posts) + per_post - 1) // per_post)
+            return [slots[index // per_post] for index in range(len(posts))]
+        units = []
+        (unit, group) = (-1, None)
+        for post in posts:
+            if post.group is None or post.group != group:
+                unit += 1
+            group = post.group
+            units.append(unit)
+        slots = self.schedule.slot_times(now, (unit + per_post) // per_post)
+        return [slots[unit // per_post] for unit in units]
+
+    def forecast(self, bot, update):
+        user_id = update.message.chat_id
+        if len(self.schedule) == 0:
+            bot.send_message(chat_id=user_id, text="There are no post times for *%s*. Use /addtime to add some."
+                                                   % self.chat.title, parse_mode='Markdown')
+            return
+        if len(self.queue) == 0:
+            bot.send_message(chat_id=user_id, text="There are no posts queued for *%s*." % self.chat.title,
+                             parse_mode='Markdown')
+            return
+        times = self.publish_times(time.time())
+        text = "*Upcoming posts for %s:*" % self.chat.title
+        for (index, post) in enumerate(self.queue):
+            if index == FORECAST_POSTS:
+                break
+            text += "\n%d. %s  %s" % (index + 1, self.to_pref_datetime(user_id, times[index]),
+                                      strip_markdown(self.describe(post)))
+        low_count = self.config['notify_low_count']
+        if self.config['notify_low'] and len(times) > low_count:
+            text += "\n\nThe queue runs low (%d posts left) after *%s*." % (
+                low_count, self.to_pref_datetime(user_id, times[len(times) - low_count - 1]))
+        text += "\nThe last of the *%d* queued posts goes out at *%s*." % (
+            len(times), self.to_pref_datetime(user_id, times[-1]))
+        if not self.has_set_timezone(user_id):
+            text += "\n\nTimes are in UTC. Use /timezone to set your time zone."
+        bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
 
     def add_time(self, bot, update, args):
         user_id = update.message.chat_id
@@ -199,17 +481,12 @@ class ChannelInstanceHandler:
                              text="Follow the /addtime command with one or more of the desired times in 24h format.\n\nFor example:\n`/addtime 0:00 8:15 16:00`",
                              parse_mode='Markdown')
             return
-        for time in args:
-            if self.to_utc_time(user_id, time) in self.config['post_times']:
-                bot.send_message(chat_id=user_id,
-                                 text="*%s* has already been added as a post time for *%s*. Try again!" % (
-                                 time, self.chat.title), parse_mode='Markdown')
-                return
-            if ':' not in time:
+        for time_string in args:
+            if ':' not in time_string:
                 bot.send_message(chat_id=user_id, text="Invalid time format for one or more arguments.")
                 return
             try:
-                units = time.split(':')
+                units = time_string.split(':')
                 hour = int(units[0])
                 minute = int(units[1])
             except ValueError:
@@ -219,14 +496,18 @@ class ChannelInstanceHandler:
                 bot.send_message(chat_id=user_id,
                                  text="Invalid time format for one or more arguments. Time out of range.")
                 return
+            if to_minutes(self.to_utc_time(user_id, time_string)) in self.schedule:
+                bot.send_message(chat_id=user_id,
+                                 text="*%s* has already been added as a post time for *%s*. Try again!" % (
+                                 time_string, self.chat.title), parse_mode='Markdown')
+                return
         for time_string in args:
             utc_time_string = self.to_utc_time(user_id, time_string)
-            hour = int(utc_time_string.split(':')[0])
-            minute = int(utc_time_string.split(':')[1])
-            utc_time = datetime.time(hour, minute)
+            if not self.schedule.add(to_minutes(utc_time_string)):
+                continue
             self.config['post_times'].append(utc_time_string)
-            name = str(self.chat.id) + utc_time_string
-            self.updater.job_queue.run_daily(self.push_post, utc_time, name=name)
+            self.persist('add_time', utc_time_string)
+            channel_queue_bot.post_scheduler.add(self, to_minutes(utc_time_string))
         if len(args) == 1:
             string = "that time"
         else:
@@ -241,17 +522,12 @@ class ChannelInstanceHandler:
                              text="Follow the /removetime command with one or more of the times as they appear in /times.\n\nFor example:\n`/removetime 0:00 8:15 16:00`",
                              parse_mode='Markdown')
             return
-        for time in args:
-            if self.to_utc_time(user_id, time) not in self.config['post_times']:
-                bot.send_message(chat_id=user_id,
-                                 text="*%s* isn't a post time for *%s*. Try again!" % (time, self.chat.title),
-                                 parse_mode='Markdown')
-                return
-            if ':' not in time:
+        for time_string in args:
+            if ':' not in time_string:
                 bot.send_message(chat_id=user_id, text="Invalid time format for one or more arguments.")
                 return
             try:
-                units = time.split(':')
+                units = time_string.split(':')
                 hour = int(units[0])
                 minute = int(units[1])
             except ValueError:
@@ -261,16 +537,20 @@ class ChannelInstanceHandler:
                 bot.send_message(chat_id=user_id,
                                  text="Invalid time format for one or more arguments. Time out of range.")
                 return
-        for time in args:
-            utc_time_string = self.to_utc_time(user_id, time)
-            hour = int(utc_time_string.split(':')[0])
-            minute = int(utc_time_string.split(':')[1])
-            utc_time = datetime.time(hour, minute)
-            self.config['post_times'].remove(utc_time_string)
-            name = str(self.chat.id) + utc_time_string
-            for job in self.updater.job_queue.jobs():
-                if job.name == name:
-                    job.schedule_removal()
+            if to_minutes(self.to_utc_time(user_id, time_string)) not in self.schedule:
+                bot.send_message(chat_id=user_id,
+                                 text="*%s* isn't a post time for *%s*. Try again!" % (time_string, self.chat.title),
+                                 parse_mode='Markdown')
+                return
+        for time_string in args:
+            minute = to_minutes(self.to_utc_time(user_id, time_string))
+            if not self.schedule.remove(minute):
+                continue
+            # stored strings may be spelled differently ("08:00" and "8:00"), match them by minute
+            for utc_time_string in [string for string in self.config['post_times'] if to_minutes(string) == minute]:
+                self.config['post_times'].remove(utc_time_string)
+                self.persist('remove_time', utc_time_string)
+            channel_queue_bot.post_scheduler.remove(self.channel_id, minute)
         if len(args) == 1:
             string = "that time"
         else:
@@ -279,87 +559,210 @@ class ChannelInstanceHandler:
                          text="Ok, I won't send posts to *%s* at %s anymore." % (self.chat.title, string),
                          parse_mode='Markdown')
 
-    def send_post(self, data_text):
+    def send_post(self, post, scheduled=None):
         disable_notifications = self.config['disable_notifications']
-        args = data_text.split(':')
-        type = args[1]
         chat_id = self.chat.id
-        if type == 't':
-            message_text = args[2].replace('&cl', ':')
-            self.bot.send_message(chat_id=chat_id, text=message_text, parse_mode='Markdown',
-                                  disable_notification=disable_notifications)
+        if post.type == 't':
+            future = self.send(self.bot.send_message, chat_id, scheduled=scheduled, text=post.payload,
+                               parse_mode='Markdown', disable_notification=disable_notifications)
+        else:
+            # stored file ids stay valid for this bot, so they are sent as is without a get_file lookup
+            (method, argument) = SEND_METHODS[post.type]
+            kwargs = {argument: post.payload}
+            if post.type not in ('s', 'vn'):
+                kwargs['caption'] = post.caption
+            future = self.send(getattr(self.bot, method), chat_id, scheduled=scheduled,
+                               disable_notification=disable_notifications, **kwargs)
+        future.add_done_callback(self.check_post_error)
+        future.add_done_callback(lambda done: self.archive_posts([post], done))
+        return future
+
+    def send_album(self, posts, scheduled=None):
+        media = [ALBUM_TYPES[post.type](post.payload, caption=post.caption) for post in posts]
+        future = self.send(self.bot.send_media_group, self.chat.id, scheduled=scheduled, media=media,
+                           disable_notification=self.config['disable_notifications'])
+        future.add_done_callback(self.check_post_error)
+        future.add_done_callback(lambda done: self.archive_posts(posts, done))
+        return future
+
+    def check_post_error(self, future):
+        # a post the Bot API refused may mean the bot lost its rights or the channel changed
+        error = future.exception()
+        if isinstance(error, TelegramError) and not isinstance(error, RetryAfter):
+            channel_queue_bot.chat_cache.invalidate(self.channel_id)
+
+    def archive_posts(self, posts, future):
+        if self.archive is None or future.exception() is not None:
             return
-        file_id = self.bot.get_file(args[2]).file_id
-        if type in ('a', 'd', 'p', 'v', 'vo'):
-            if len(args) > 3:
-                caption = args[3].replace('&cl', ':')
+        result = future.result()
+        messages = result if isinstance(result, list) else [result] * len(posts)
+        now = time.time()
+        for (post, message) in zip(posts, messages):
+            # results are Message objects, or plain dicts for albums sent by the asyncio runtime
+            if isinstance(message, dict):
+                message_id = message.get('message_id')
             else:
-                caption = None
-            if type == 'a':
-                self.bot.send_audio(chat_id=chat_id, audio=file_id, caption=caption,
-                                    disable_notification=disable_notifications)
-            elif type == 'd':
-                self.bot.send_document(chat_id=chat_id, document=file_id, caption=caption,
-                                       disable_notification=disable_notifications)
-            elif type == 'p':
-                self.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption,
-                                    disable_notification=disable_notifications)
-            elif type == 'v':
-                self.bot.send_video(chat_id=chat_id, video=file_id, caption=caption,
-                                    disable_notification=disable_notifications)
+                message_id = getattr(message, 'message_id', None)
+            if post.type == 't':
+                self.archive.append(now, post.type, None, post.payload, message_id)
             else:
-                self.bot.send_voice(chat_id=chat_id, voice=file_id, caption=caption,
-                                    disable_notification=disable_notifications)
+                self.archive.append(now, post.type, post.payload, post.caption, message_id)
+
+    def stats(self, bot, update):
+        user_id = update.message.chat_id
+        if self.archive is None:
+            bot.send_message(chat_id=user_id, text="Post history is turned off for this bot.")
             return
+        now = time.time()
+        counts = self.archive.counts(now - 29 * DAY, now)
+        text = "*Posts published in %s over the last week:*" % self.chat.title
+        for days_ago in range(6, -1, -1):
+            timestamp = now - days_ago * DAY
+            by_type = counts.get(day_string(timestamp), {})
+            line = "\n`%s`  %d" % (time.strftime("%a %d %b", time.gmtime(timestamp)), sum(by_type.values()))
+            if len(by_type) > 0:
+                line += " (%s)" % ", ".join("%d %s" % (count, TYPE_NAMES[type].lower())
+                                            for (type, count) in sorted(by_type.items(), key=lambda item: -item[1]))
+            text += line
+        week = sum(sum(counts.get(day_string(now - days_ago * DAY), {}).values()) for days_ago in range(7))
+        month = sum(sum(by_type.values()) for by_type in counts.values())
+        text += "\n\nOn average *%.1f* posts a day went out over the last 7 days and *%.1f* over the last 30." % (
+            week / 7.0, month / 30.0)
+        per_day = self.config['per_post'] * len(self.schedule)
+        text += "\n\n*%d* posts are queued." % len(self.queue)
+        if per_day > 0 and len(self.queue) > 0:
+            last = self.publish_times(now)[-1]
+            text += " At *%d* posts a day that is *%.1f* days of runway, until *%s*." % (
+                per_day, (last - now) / DAY, self.to_pref_datetime(user_id, last))
+        bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+
+    def send_posts(self, posts, scheduled=None):
+        if not self.config.get('group_media', False):
+            for post in posts:
+                self.send_post(post, scheduled)
+            return
+        # consecutive photos and videos due in the same slot go out as media groups of up to ALBUM_SIZE
+        album = []
+        for post in posts + [None]:
+            if post is not None and post.type in ALBUM_TYPES and len(album) < ALBUM_SIZE:
+                album.append(post)
+                continue
+            if len(album) == 1:
+                self.send_post(album[0], scheduled)
+            elif len(album) > 1:
+                self.send_album(album, scheduled)
+            album = []
+            if post is not None:
+                if post.type in ALBUM_TYPES:
+                    album.append(post)
+                else:
+                    self.send_post(post, scheduled)
+
+    def pop_unit(self):
+        # with group_media a forwarded album is one queue unit, otherwise every post is
+        posts = [self.queue.popleft()]
+        if self.config.get('group_media', False) and posts[0].group is not None:
+            while len(self.queue) > 0 and self.queue.peek().group == posts[0].group:
+                posts.append(self.queue.popleft())
+        for post in posts:
+            self.dedup.published(post)
+            self.persist('remove_post', post.id)
+        return posts
 
-    def push_post(self, bot, job):
+    def push_post(self, bot, job, scheduled=None):
+        if scheduled is None:
+            # post times are whole minutes, so the slot this run belongs to is the start of the current minute
+            scheduled = time.time() // 60 * 60
+        # posts were added since the last alerts, so the queue running low or empty again is news
+        if len(self.queue) > 0:
+            channel_queue_bot.notifier.clear(self.channel_id, 'empty')
+        if len(self.queue) > self.config['notify_low_count']:
+            channel_queue_bot.notifier.clear(self.channel_id, 'low')
+        posts = []
         for i in range(0, self.config['per_post']):
             if len(self.queue) == 0:
-                for admin_id in self.config['admins']:
-                    self.bot.send_message(chat_id=admin_id, text="No more posts queued for %s!" % self.chat.title)
-                return
-            self.send_post(self.queue[0])
-            del self.queue[0]
-            if self.config['notify_low'] and len(self.queue) == self.config['notify_low_count']:
-                for admin_id in self.config['admins']:
-                    self.bot.send_message(chat_id=admin_id, text="There are fewer than %d posts queued for %s!" % (
-                        self.config['notify_low_count'], self.chat.title))
+                if self.config['notify_queue_empty']:
+                    self.notify_admins('empty', "No more posts queued for %s!" % self.chat.title)
+                break
+            before = len(self.queue)
+            posts += self.pop_unit()
+            if self.config['notify_low'] and len(self.queue) <= self.config['notify_low_count'] < before:
+                self.notify_admins('low', "There are fewer than %d posts queued for %s!" % (
+                    self.config['notify_low_count'], self.chat.title))
+        self.send_posts(posts, scheduled)
+
+    def notify_admins(self, kind, text):
+        opted_out = self.config.get('notify_optout', [])
+        admin_ids = [admin_id for admin_id in self.config['admins'] if admin_id not in opted_out]
+        channel_queue_bot.notifier.notify(self.channel_id, kind, self.send_notice, admin_ids, text)
+
+    def send_notice(self, admin_id, text):
+        self.send(self.bot.send_message, admin_id, PRIORITY_NOTICE, text=text)
+
+    def set_group_media(self, bot, update, args):
+        user_id = update.message.chat_id
+        if len(args) != 1 or args[0].lower() not in ('on', 'off'):
+            state = "on" if self.config.get('group_media', False) else "off"
+            bot.send_message(chat_id=user_id,
+                             text="Album posting is *%s* for *%s*. Use `/albums on` or `/albums off` to change it."
+                                  % (state, self.chat.title), parse_mode='Markdown')
+            return
+        self.config['group_media'] = args[0].lower() == 'on'
+        self.persist('save_settings', self.config)
+        if self.config['group_media']:
+            text = "Ok, photos and videos posted to *%s* in the same slot will be sent as albums." % self.chat.title
+        else:
+            text = "Ok, every post in *%s* will be sent on its own." % self.chat.title
+        bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+
+    def set_notifications(self, bot, update, args):
+        user_id = update.message.chat_id
+        opted_out = self.config.setdefault('notify_optout', [])
+        if len(args) != 1 or args[0].lower() not in ('on', 'off'):
+            state = "off" if user_id in opted_out else "on"
+            bot.send_message(chat_id=user_id,
+                             text="Queue notices from *%s* are *%s* for you. Use `/notify on` or `/notify off` to "
+                                  "change it." % (self.chat.title, state), parse_mode='Markdown')
+            return
+        if args[0].lower() == 'off':
+            if user_id not in opted_out:
+                opted_out.append(user_id)
+            text = "Ok, you won't get notices about the queue for *%s* anymore." % self.chat.title
+        else:
+            if user_id in opted_out:
+                opted_out.remove(user_id)
+            text = "Ok, you'll be told when the queue for *%s* runs low or empty." % self.chat.title
+        self.persist('save_settings', self.config)
+        bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+
+    def send(self, func, chat_id, priority=PRIORITY_POST, scheduled=None, **kwargs):
+        future = channel_queue_bot.send_scheduler.submit(func, chat_id, priority, scheduled, **kwargs)
+        future.add_done_callback(self.log_send_error)
+        return future
+
+    def log_send_error(self, future):
+        if future.exception() is not None:
+            self.warning("Failed to send message: %s" % future.exception())
+
+    def timezone_pref(self, user_id):
+        # an IANA zone name, or a legacy UTC offset for prefs set before zones were supported
+        return self.g_config['timezone_prefs'].get(str(user_id), 0)
 
     def to_pref_time(self, user_id, time_string):
         if not self.has_set_timezone(user_id):
             return time_string
-        utc_offset = int(self.g_config['timezone_prefs'][str(user_id)])
-        args = time_string.split(':')
-        hour = args[0]
-        minute = int(args[1])
-        hour = int(hour) + utc_offset
-        if hour < 0:
-            hour += 24
-        elif hour > 23:
-            hour -= 24
-        time = datetime.time(hour, minute)
-        string = time.strftime("%H:%M")
-        if string[0] == '0':
-            string = string[1:]
-        return string
+        return to_time_string(timezones.to_local_minute(self.timezone_pref(user_id), to_minutes(time_string),
+                                                        time.time()))
 
     def to_utc_time(self, user_id, time_string):
         if not self.has_set_timezone(user_id):
             return time_string
-        utc_offset = int(self.g_config['timezone_prefs'][str(user_id)]) * -1
-        args = time_string.split(':')
-        hour = args[0]
-        minute = int(args[1])
-        hour = int(hour) + utc_offset
-        if hour < 0:
-            hour += 24
-        elif hour > 23:
-            hour -= 24
-        time = datetime.time(hour, minute)
-        string = time.strftime("%H:%M")
-        if string[0] == '0':
-            string = string[1:]
-        return string
+        return to_time_string(timezones.to_utc_minute(self.timezone_pref(user_id), to_minutes(time_string),
+                                                      time.time()))
+
+    def to_pref_datetime(self, user_id, timestamp):
+        offset = timezones.utc_offset(self.timezone_pref(user_id), timestamp)
+        return time.strftime("%a %d %b %H:%M", time.gmtime(timestamp + offset * 60))
 
     def has_set_timezone(self, user_id):
         if str(user_id) in self.g_config['timezone_prefs']:
@@ -375,14 +778,35 @@ class ChannelInstanceHandler:
 
     def bot_is_admin(self, update):
         try:
-            admins = self.chat.get_administrators()
+            channel_queue_bot.chat_cache.get_administrators(self.bot, self.channel_id)
             return True
         except TelegramError:
             return False
 
     def dump_data(self):
-        self.config['queued_posts'] = self.queue
+        # clear the flag first so mutations made while copying mark the channel dirty again
+        self.dirty = False
+        self.save_history()
         self.g_config['channels'][str(self.channel_id)] = self.config
+        data = {key: copy.copy(value) for (key, value) in self.config.items()}
+        if self.store is not None:
+            # the store already holds the queue, keep it out of config.json
+            del data['queued_posts']
+        else:
+            data['queued_posts'] = self.queue.to_data()
+        return data
+
+    def save_history(self):
+        # posts are recorded as published once their sends complete, which doesn't mark the channel dirty
+        if self.dedup.history is not None:
+            self.dedup.history.save()
+        if self.archive is not None:
+            self.archive.flush()
+
+    def persist(self, method, *args):
+        self.dirty = True
+        if self.store is not None:
+            getattr(self.store, method)(self.channel_id, *args)
 
     def warning(self, text):
         channel_queue_bot.logger.warning("%s: %s" % (self.bot_name, text))
@@ -1,14 +1,34 @@
+import copy
 import datetime
 import datetime
 import json
 import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from functools import wraps
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, TelegramError, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, ReplyKeyboardMarkup, ReplyKeyboardRemove, TelegramError, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
+from telegram.utils.request import Request
 
 import channel_instance_handler
+import metrics
+import profiler
+import sharding
+import timezones
+from async_runtime import AsyncRuntime
+from chat_cache import ChatCache
+from config_writer import ConfigWriter
+from journal_store import JournalStore
+from notifier import Notifier
+from post_scheduler import PostScheduler
+from send_scheduler import SendScheduler
+from sqlite_store import SqliteStore
+from webhook_server import WebhookServer
+
+ZONE_PAGE_SIZE = 16
 
 # setup logger
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -24,20 +44,50 @@ def import_config():
     config = data
 
 
+def open_store():
+    global store
+    dir = os.path.dirname(__file__)
+    backend = config.get('storage', 'json')
+    if backend == 'sqlite':
+        store = SqliteStore(os.path.join(dir, config.get('database', 'queue.db')))
+    elif backend == 'journal':
+        store = JournalStore(os.path.join(dir, config.get('journal_dir', 'journal')),
+                             compact_size=config.get('journal_compact_size', 1 << 20))
+    else:
+        return
+    config['timezone_prefs'].update(store.timezone_prefs())
+
+
 config = {}
 channel_handlers = {}
 updater = None
+updaters = {}
+store = None
+config_writer = None
+chat_cache = ChatCache()
+send_scheduler = SendScheduler()
+post_scheduler = PostScheduler()
+notifier = Notifier()
+runtime = None
+coordinator = None
+bootstrap_futures = []
+startup_time = time.time()
 
 
 def needs_focus(func):
+    func = profiler.hook('%s.focused' % func.__name__, func)
+
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         user_id = update.message.chat_id
-        if str(user_id) not in config['focus_channels']:
+        if str(user_id) not in bot_config(bot)['focus_channels']:
             bot.send_message(chat_id=user_id,
                              text="You are not currently working with a channel. Use /select to start working with a channel.")
             return
-        channel_handler = channel_handlers[str(config['focus_channels'][str(user_id)])]
+        channel_handler = channel_handlers.get(str(bot_config(bot)['focus_channels'][str(user_id)]))
+        if channel_handler is None:
+            bot.send_message(chat_id=user_id, text="That channel is still loading. Try again in a moment!")
+            return
         if user_id not in channel_handler.config['admins']:
             bot.send_message(chat_id=user_id, text="You are not an admin in %s!" % channel_handler.chat.title)
             return
@@ -47,14 +97,19 @@ def needs_focus(func):
 
 
 def needs_focus_args(func):
+    func = profiler.hook('%s.focused' % func.__name__, func)
+
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         user_id = update.message.chat_id
-        if str(user_id) not in config['focus_channels']:
+        if str(user_id) not in bot_config(bot)['focus_channels']:
             bot.send_message(chat_id=user_id,
                              text="You are not currently working with a channel. Use /select to start working with a channel.")
             return
-        channel_handler = channel_handlers[str(config['focus_channels'][str(user_id)])]
+        channel_handler = channel_handlers.get(str(bot_config(bot)['focus_channels'][str(user_id)]))
+        if channel_handler is None:
+            bot.send_message(chat_id=user_id, text="That channel is still loading. Try again in a moment!")
+            return
         if user_id not in channel_handler.config['admins']:
             bot.send_message(chat_id=user_id, text="You are not an admin in %s!" % channel_handler.chat.title)
             return
@@ -67,54 +122,236 @@ def get_config():
     return config
 
 
+def bot_id_of(token):
+    # bot tokens start with the bot's user id
+    return int(token.split(':')[0])
+
+
+def bot_config(bot):
+    # users' state for the main token lives at the top level of config.json, other tokens keep theirs under bots
+    if bot.token == config['token']:
+        return config
+    return config['bots'][bot.token]
+
+
+def serves(bot, channel):
+    # every hosted token has its own channels, those without a bot_id belong to the main token
+    return channel.config.get('bot_id', bot_id_of(config['token'])) == bot_id_of(bot.token)
+
+
 def main():
+    global startup_time
+    startup_time = time.time()
     import_config()
+    setup()
+    if config.get('shards', 0) > 0:
+        global coordinator
+        coordinator = sharding.ShardCoordinator(config, config['shards'])
+    dispatcher = updater.dispatcher
+    register_metrics()
+    for hosted in updaters.values():
+        if hosted is not updater:
+            register_handlers(hosted.dispatcher)
+
+    # start handlers for each channel in config, in worker processes when sharded
+    if coordinator is not None:
+        coordinator.start(all_channel_ids())
+    else:
+        register_channel_handlers(all_channel_ids())
+    register_handlers(dispatcher)
+
+    # start loops
+    updater.job_queue.run_repeating(dump_data, 900)
+    updater.job_queue.run_repeating(update_admins, 900)
+    updater.job_queue.run_repeating(log_send_stats, 900)
 
+    # start the bots
+    if config.get('update_mode', 'polling') == 'webhook':
+        start_webhook(dispatcher)
+    else:
+        for hosted in updaters.values():
+            hosted.start_polling()
+        logger.info('Polling started %.1fs after startup' % (time.time() - startup_time))
+    updater.idle()
+    # save the queues and the buffered history and archives before exiting
+    dump_data().wait()
+    if coordinator is not None:
+        coordinator.stop()
+
+
+def setup():
+    open_store()
+    chat_cache.ttl = config.get('chat_cache_ttl', 300)
+    notifier.interval = config.get('notify_interval', 24 * 60 * 60)
+    profiler.enabled = config.get('profiling', False)
+    profiler.instrument(channel_instance_handler.ChannelInstanceHandler)
+    global send_scheduler
+    send_scheduler = SendScheduler(config.get('send_rate', 30), config.get('chat_send_rate', 1),
+                                   config.get('chat_send_burst', 3), config.get('send_workers', 8))
+    if config.get('execution_mode', 'threads') == 'asyncio':
+        global runtime
+        runtime = AsyncRuntime(config.get('async_connections', 100))
+        send_scheduler.runtime = runtime
+
+    # every hosted token gets its own updater and dispatcher, their Bot API calls share one connection pool
+    tokens = [config['token']] + [token for token in config.get('bots', {}) if token != config['token']]
+    request = Request(con_pool_size=config.get('http_connections', 4 + 4 * len(tokens)))
+    for token in tokens:
+        updaters[bot_id_of(token)] = Updater(bot=Bot(token=token, request=request))
+    for settings in config.get('bots', {}).values():
+        settings.setdefault('focus_channels', {})
+        settings.setdefault('waiting_for_channel_setup', [])
+        settings.setdefault('waiting_for_channel_select', [])
     global updater
-    updater = Updater(config['token'])
-    dispatcher = updater.dispatcher
+    updater = updaters[bot_id_of(config['token'])]
+
 
+def start_worker(worker_config, channel_ids):
+    # entry point of a shard process, which only runs its channels' handlers and their post loops
+    global config
+    config = worker_config
+    setup()
+    register_process_metrics()
+    metrics.gauge('queue_depth', lambda: [({'channel': handler.channel_id}, len(handler.queue))
+                                          for handler in list(channel_handlers.values())])
+    for hosted in updaters.values():
+        hosted.job_queue.start()
+    register_channel_handlers(channel_ids)
+
+
+def register_handlers(dispatcher):
     # register error handler
     dispatcher.add_error_handler(error)
 
-    # start handlers for each channel in config
-    register_channel_handlers()
-
     # register commands
-    dispatcher.add_handler(CommandHandler('addchannel', add_channel))
-    dispatcher.add_handler(CommandHandler('cancel', cancel_process))
-    dispatcher.add_handler(CommandHandler('select', select_channel))
-    dispatcher.add_handler(CommandHandler('dump', dump_data))
-    dispatcher.add_handler(CommandHandler('shuffle', shuffle_queue))
-    dispatcher.add_handler(CommandHandler('focus', focus_command))
-    dispatcher.add_handler(CommandHandler('queue', queue_command))
-    dispatcher.add_handler(CommandHandler('timezone', select_timezone))
-    dispatcher.add_handler(CommandHandler('times', times))
-    dispatcher.add_handler(CommandHandler(['addtime', 'addtimes'], add_time, pass_args=True))
-    dispatcher.add_handler(CommandHandler(['removetime', 'removetimes'], remove_time, pass_args=True))
+    dispatcher.add_handler(CommandHandler('addchannel', adapt(add_channel)))
+    dispatcher.add_handler(CommandHandler('cancel', adapt(cancel_process)))
+    dispatcher.add_handler(CommandHandler('select', adapt(select_channel)))
+    dispatcher.add_handler(CommandHandler('dump', adapt(dump_data)))
+    dispatcher.add_handler(CommandHandler('shuffle', adapt(shuffle_queue), pass_args=True))
+    dispatcher.add_handler(CommandHandler('focus', adapt(focus_command)))
+    dispatcher.add_handler(CommandHandler('queue', adapt(queue_command)))
+    dispatcher.add_handler(CommandHandler('timezone', adapt(select_timezone)))
+    dispatcher.add_handler(CommandHandler('times', adapt(times)))
+    dispatcher.add_handler(CommandHandler(['next', 'forecast'], adapt(forecast)))
+    dispatcher.add_handler(CommandHandler('stats', adapt(stats)))
+    dispatcher.add_handler(CommandHandler(['addtime', 'addtimes'], adapt(add_time), pass_args=True))
+    dispatcher.add_handler(CommandHandler(['removetime', 'removetimes'], adapt(remove_time), pass_args=True))
+    dispatcher.add_handler(CommandHandler('albums', adapt(albums_command), pass_args=True))
+    dispatcher.add_handler(CommandHandler('notify', adapt(notify_command), pass_args=True))
+    dispatcher.add_handler(CommandHandler('bulk', adapt(bulk_command)))
+    dispatcher.add_handler(CommandHandler('done', adapt(done_command)))
+    dispatcher.add_handler(CommandHandler('profile', adapt(profile_command), pass_args=True))
+    dispatcher.add_handler(CommandHandler('shards', adapt(shards_command), pass_args=True))
 
     # register message listeners
-    dispatcher.add_handler(MessageHandler(~ Filters.command, message_received))
-    dispatcher.add_handler(MessageHandler(Filters.command, unknown_command))
+    dispatcher.add_handler(MessageHandler(~ Filters.command, adapt(message_received)))
+    dispatcher.add_handler(MessageHandler(Filters.command, adapt(unknown_command)))
 
     # register button handlers
-    dispatcher.add_handler(CallbackQueryHandler(remove_post, pattern="remove"))
-    dispatcher.add_handler(CallbackQueryHandler(select_timezone, pattern="select_timezone"))
-    dispatcher.add_handler(CallbackQueryHandler(select_timezone, pattern="set_timezone"))
+    dispatcher.add_handler(CallbackQueryHandler(adapt(remove_post), pattern="remove"))
+    dispatcher.add_handler(CallbackQueryHandler(adapt(bulk_page), pattern="bulk_"))
+    dispatcher.add_handler(CallbackQueryHandler(adapt(add_duplicate), pattern="dup_add"))
+    dispatcher.add_handler(CallbackQueryHandler(adapt(select_timezone), pattern="select_timezone"))
+    dispatcher.add_handler(CallbackQueryHandler(adapt(select_timezone), pattern="set_timezone"))
+    dispatcher.add_handler(CallbackQueryHandler(adapt(select_timezone), pattern="tz_"))
+
+
+def adapt(callback):
+    name = callback.__name__
+    callback = profiler.hook(name, callback)
+    if runtime is not None:
+        callback = runtime.adapt(callback)
+    return metrics.timed('handler_seconds', callback, handler=name)
+
+
+def register_metrics():
+    register_process_metrics()
+    metrics.gauge('dispatcher_backlog', lambda: sum(hosted.dispatcher.update_queue.qsize()
+                                                    for hosted in updaters.values()))
+    if coordinator is not None:
+        metrics.add_source(coordinator.collect_metrics)
+    else:
+        metrics.gauge('queue_depth', lambda: [({'channel': handler.channel_id}, len(handler.queue))
+                                              for handler in list(channel_handlers.values())])
+    if 'metrics_port' in config:
+        metrics.start_server(config['metrics_port'])
+    if 'metrics_file' in config:
+        updater.job_queue.run_repeating(dump_metrics, config.get('metrics_interval', 60))
 
-    # start loops
-    updater.job_queue.run_repeating(dump_data, 900)
-    updater.job_queue.run_repeating(update_admins, 900)
 
-    # start the bot
-    updater.start_polling()
-    updater.idle()
+def register_process_metrics():
+    # series every process has, shard workers report these as their own
+    for hosted in updaters.values():
+        metrics.instrument_bot(hosted.bot)
+    metrics.gauge('send_backlog', send_scheduler.backlog)
+    metrics.gauge('send_retry_after', lambda: send_scheduler.retry_after_count)
+    metrics.gauge('notice_backlog', notifier.backlog)
 
 
-def register_channel_handlers():
-    global channel_handlers
-    for channel_id in config['channels']:
-        channel_handlers[channel_id] = channel_instance_handler.ChannelInstanceHandler(updater, channel_id, config)
+def dump_metrics(bot=None, job=None):
+    dir = os.path.dirname(__file__)
+    path = os.path.join(dir, config['metrics_file'])
+    with open(path + '.tmp', 'w') as f:
+        f.write(metrics.render())
+    os.replace(path + '.tmp', path)
+
+
+def start_webhook(dispatcher):
+    settings = config['webhook']
+    server = WebhookServer(dispatcher, updater.bot, settings.get('listen', '0.0.0.0'), settings.get('port', 8443),
+                           settings.get('path', '/'), settings.get('secret_token'), settings.get('workers', 4),
+                           settings.get('queue_size', 1000))
+    urls = {bot_id_of(config['token']): settings.get('url')}
+    # the other tokens share the server, each under its bot id appended to the path
+    for (bot_id, hosted) in updaters.items():
+        if hosted is not updater:
+            server.add_route('%s/%d' % (settings.get('path', '/').rstrip('/'), bot_id), hosted.dispatcher, hosted.bot)
+            if 'url' in settings:
+                urls[bot_id] = '%s/%d' % (settings['url'].rstrip('/'), bot_id)
+    for hosted in updaters.values():
+        hosted.job_queue.start()
+    server.start()
+    metrics.gauge('webhook_backlog', server.updates.qsize)
+    if 'url' in settings:
+        for (bot_id, hosted) in updaters.items():
+            hosted.bot.set_webhook(url=urls[bot_id], max_connections=settings.get('workers', 4),
+                                   secret_token=settings.get('secret_token'))
+    logger.info('Webhook started %.1fs after startup' % (time.time() - startup_time))
+
+
+def all_channel_ids():
+    channel_ids = list(config['channels'])
+    if store is not None:
+        channel_ids += [channel_id for channel_id in store.channel_ids() if channel_id not in config['channels']]
+    return channel_ids
+
+
+def connect_channel(channel_id, bot_id=None):
+    handler = channel_instance_handler.ChannelInstanceHandler(updater, channel_id, config, store, bot_id)
+    channel_handlers[str(channel_id)] = handler
+    return handler
+
+
+def register_channel_handlers(channel_ids):
+    bot_id = updater.bot.get_me().id
+    executor = ThreadPoolExecutor(max_workers=config.get('bootstrap_workers', 8))
+    futures = {executor.submit(connect_channel, channel_id, bot_id): channel_id for channel_id in channel_ids}
+    bootstrap_futures.extend(futures)
+    executor.shutdown(wait=False)
+
+    def log_bootstrap():
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                logger.error('Failed to connect channel %s: %s' % (futures[future], future.exception()))
+        logger.info('%d of %d channels ready %.1fs after startup' % (
+            len(channel_handlers), len(channel_ids), time.time() - startup_time))
+
+    threading.Thread(target=log_bootstrap, name='channel-bootstrap', daemon=True).start()
+
+
+def wait_for_channels():
+    wait(bootstrap_futures)
 
 
 def start(bot, update):
@@ -123,12 +360,73 @@ def start(bot, update):
 
 @needs_focus
 def queue_command(bot, update, focus_channel):
-    user_id = update.message.from_user.id
-    bot.send_message(chat_id=update.message.chat_id, text="There are currently *%d* posts queued for *%s*" % (
-    len(focus_channel.queue), focus_channel.chat.title), parse_mode='Markdown')
+    focus_channel.queue_status(bot, update)
 
 
 def select_timezone(bot, update):
+    if not timezones.available():
+        select_offset(bot, update)
+        return
+    query = update.callback_query
+    if query is None:
+        (text, markup) = region_menu(update.message.chat_id)
+        bot.send_message(chat_id=update.message.chat_id, text=text, parse_mode='Markdown', reply_markup=markup)
+        return
+    args = query.data.split(':')
+    if args[0] in ('select_timezone', 'set_timezone'):
+        # buttons of offset pickers sent before zones were supported
+        select_offset(bot, update)
+        return
+    if args[0] == 'tz_set':
+        name = args[1]
+        if not timezones.is_zone(name):
+            query.answer(text="Unknown time zone.")
+            return
+        config['timezone_prefs'][str(query.from_user.id)] = name
+        if store is not None:
+            store.set_timezone(query.from_user.id, name)
+        query.edit_message_text(text="Your time zone has been set to *%s*." % timezones.describe(name, time.time()),
+                                parse_mode='Markdown', reply_markup=None)
+        query.answer()
+        return
+    if args[0] == 'tz_region':
+        (text, markup) = zone_menu(args[1], int(args[2]))
+    else:
+        (text, markup) = region_menu(query.from_user.id)
+    query.edit_message_text(text=text, parse_mode='Markdown', reply_markup=markup)
+    query.answer()
+
+
+def region_menu(user_id):
+    text = "Select the region of your time zone."
+    if str(user_id) in config['timezone_prefs']:
+        text = "Your time zone is *%s*.\n\n" % timezones.describe(config['timezone_prefs'][str(user_id)],
+                                                                   time.time()) + text
+    buttons = [InlineKeyboardButton(region, callback_data="tz_region:%s:0" % region)
+               for region in sorted(timezones.all_zones())]
+    keyboard = [buttons[index:index + 3] for index in range(0, len(buttons), 3)]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def zone_menu(region, page):
+    names = timezones.all_zones().get(region, [])
+    pages = max(1, (len(names) + ZONE_PAGE_SIZE - 1) // ZONE_PAGE_SIZE)
+    page %= pages
+    now = time.time()
+    buttons = []
+    for name in names[page * ZONE_PAGE_SIZE:(page + 1) * ZONE_PAGE_SIZE]:
+        label = "%s (%s)" % (name.split('/', 1)[-1].replace('_', ' '),
+                             timezones.offset_text(timezones.utc_offset(name, now)))
+        buttons.append(InlineKeyboardButton(label, callback_data="tz_set:%s" % name))
+    keyboard = [buttons[index:index + 2] for index in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton("⬅", callback_data="tz_region:%s:%d" % (region, (page - 1) % pages)),
+                     InlineKeyboardButton("Regions", callback_data="tz_regions"),
+                     InlineKeyboardButton("➡", callback_data="tz_region:%s:%d" % (region, (page + 1) % pages))])
+    text = "Select your time zone in *%s* (page %d of %d)." % (region, page + 1, pages)
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def select_offset(bot, update):
     global config
     index = 0
     if update.callback_query is not None:
@@ -140,6 +438,8 @@ def select_timezone(bot, update):
             user_id = query.from_user.id
             timezone = config['timezones'][int(args[1])]
             config['timezone_prefs'][str(user_id)] = int(timezone)
+            if store is not None:
+                store.set_timezone(user_id, int(timezone))
             query.edit_message_text(text="Your time zone has been set to *UTC%s*." % timezone, parse_mode='Markdown',
                                     reply_markup=None)
             query.answer()
@@ -196,6 +496,16 @@ def times(bot, update, focus_channel):
     focus_channel.times(bot, update)
 
 
+@needs_focus
+def forecast(bot, update, focus_channel):
+    focus_channel.forecast(bot, update)
+
+
+@needs_focus
+def stats(bot, update, focus_channel):
+    focus_channel.stats(bot, update)
+
+
 @needs_focus_args
 def add_time(bot, update, focus_channel, args):
     focus_channel.add_time(bot, update, args)
@@ -206,20 +516,40 @@ def remove_time(bot, update, focus_channel, args):
     focus_channel.remove_time(bot, update, args)
 
 
+@needs_focus_args
+def shuffle_queue(bot, update, focus_channel, args):
+    focus_channel.shuffle(bot, update, args)
+
+
+@needs_focus_args
+def albums_command(bot, update, focus_channel, args):
+    focus_channel.set_group_media(bot, update, args)
+
+
+@needs_focus_args
+def notify_command(bot, update, focus_channel, args):
+    focus_channel.set_notifications(bot, update, args)
+
+
+@needs_focus
+def bulk_command(bot, update, focus_channel):
+    focus_channel.start_bulk(bot, update)
+
+
 @needs_focus
-def shuffle_queue(bot, update, focus_channel):
-    focus_channel.shuffle(bot, update)
+def done_command(bot, update, focus_channel):
+    focus_channel.finish_bulk(bot, update)
 
 
 def cancel_process(bot, update):
     user_id = update.message.chat_id
     global config
-    if user_id in config['waiting_for_channel_setup']:
-        config['waiting_for_channel_setup'].remove(user_id)
+    if user_id in bot_config(bot)['waiting_for_channel_setup']:
+        bot_config(bot)['waiting_for_channel_setup'].remove(user_id)
         bot.send_message(chat_id=user_id, text="Ok, I've canceled the setup process for a new channel.")
         return
-    if user_id in config['waiting_for_channel_select']:
-        config['waiting_for_channel_select'].remove(user_id)
+    if user_id in bot_config(bot)['waiting_for_channel_select']:
+        bot_config(bot)['waiting_for_channel_select'].remove(user_id)
         bot.send_message(chat_id=user_id, text="Ok, I've canceled selecting a channel.")
         return
     bot.send_message(chat_id=user_id, text="Were you doing something?")
@@ -227,11 +557,15 @@ def cancel_process(bot, update):
 
 def focus_command(bot, update):
     user_id = update.message.chat_id
-    if str(user_id) not in config['focus_channels']:
+    if str(user_id) not in bot_config(bot)['focus_channels']:
         bot.send_message(chat_id=user_id,
                          text="You are not currently working with any channels. Use /select to start working with a registered channel.")
         return
-    focus_title = channel_handlers[str(config['focus_channels'][str(user_id)])].chat.title
+    focus_channel = channel_handlers.get(str(bot_config(bot)['focus_channels'][str(user_id)]))
+    if focus_channel is None:
+        bot.send_message(chat_id=user_id, text="That channel is still loading. Try again in a moment!")
+        return
+    focus_title = focus_channel.chat.title
     bot.send_message(chat_id=user_id,
                      text="*You are currently working with %s.*\n\nAny messages you send to me will be queued "
                           "for %s and any channel-specific commands will also target %s.\n\nYou can "
@@ -242,13 +576,13 @@ def focus_command(bot, update):
 def add_channel(bot, update):
     global config
     user_id = update.message.chat_id
-    if user_id in config['waiting_for_channel_setup']:
+    if user_id in bot_config(bot)['waiting_for_channel_setup']:
         bot.send_message(chat_id=user_id,
                          text="You are already in the process of setting up a channel. Forward a from the target channel to me or use /cancel to cancel the setup process.")
         return
     bot.send_message(chat_id=user_id,
                      text="Ok, let's set up a queue for a channel. Forward a message from the target channel to me.")
-    config['waiting_for_channel_setup'].append(user_id)
+    bot_config(bot)['waiting_for_channel_setup'].append(user_id)
 
 
 def setup_channel(bot, update):
@@ -268,46 +602,50 @@ def setup_channel(bot, update):
 
     # assure bot is admin in target channel
     try:
-        admins = target_chat.get_administrators()
+        admins = chat_cache.get_administrators(bot, target_chat.id, refresh=True)
     except TelegramError:
         bot.send_message(chat_id=user_id,
                          text="You need to add me as an admin in %s to establish a queue." % target_chat.title)
-        config['waiting_for_channel_setup'].remove(user_id)
+        bot_config(bot)['waiting_for_channel_setup'].remove(user_id)
         return
 
     # assure user is channel creator
     chat_member = None
-    for admin in target_chat.get_administrators():
+    for admin in admins:
         if admin.user.id == user_id:
             chat_member = admin
     if chat_member is None or chat_member.status != 'creator':
         bot.send_message(chat_id=user_id, text="Only the channel creator can set up a queue for a channel!")
-        config['waiting_for_channel_setup'].remove(user_id)
+        bot_config(bot)['waiting_for_channel_setup'].remove(user_id)
         return
 
     # assure channel isn't already registered
-    if str(target_chat.id) in config['channels']:
+    if str(target_chat.id) in config['channels'] or str(target_chat.id) in channel_handlers:
         bot.send_message(chat_id=user_id,
                          text="Good news! A queue for that channel has already been setup. Use /select to start working with it.")
-        config['waiting_for_channel_setup'].remove(user_id)
+        bot_config(bot)['waiting_for_channel_setup'].remove(user_id)
         return
 
-    # register and store new channel instance handler
-    global channel_handlers
-    new_handler = channel_instance_handler.ChannelInstanceHandler(updater, target_chat.id, config)
-    channel_handlers[str(target_chat.id)] = new_handler
+    # register and store new channel instance handler, run by the bot it was set up with
+    data = None
+    if bot.token != config['token']:
+        data = config['channels'][str(target_chat.id)] = {'bot_id': bot_id_of(bot.token)}
+    if coordinator is not None:
+        coordinator.add_channel(target_chat.id, data)
+    else:
+        connect_channel(target_chat.id)
 
     bot.send_message(chat_id=user_id,
                      text="I've successfully set up a queue for *%s*! Use /select to start working with it." % target_chat.title,
                      parse_mode='Markdown')
-    config['waiting_for_channel_setup'].remove(user_id)
+    bot_config(bot)['waiting_for_channel_setup'].remove(user_id)
 
 
 def select_channel(bot, update):
     user_id = update.message.chat_id
     available_channels = []
-    for channel in channel_handlers.values():
-        if user_id in channel.config['admins']:
+    for channel in list(channel_handlers.values()):
+        if user_id in channel.config['admins'] and serves(bot, channel):
             available_channels.append(channel)
     if len(available_channels) == 0:
         bot.send_message(chat_id=user_id, text="You are not an admin in any registered channels!")
@@ -323,14 +661,14 @@ def select_channel(bot, update):
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
     bot.send_message(chat_id=user_id, text="Select which channel you want to work with.", reply_markup=markup)
     global config
-    config['waiting_for_channel_select'].append(user_id)
+    bot_config(bot)['waiting_for_channel_select'].append(user_id)
 
 
 def select_channel_reply(bot, update):
     channel_title = update.message.text
     user_id = update.message.chat_id
     global config
-    config['waiting_for_channel_select'].remove(user_id)
+    bot_config(bot)['waiting_for_channel_select'].remove(user_id)
 
     # make sure response is a text message
     if update.message.text is None:
@@ -347,8 +685,8 @@ def select_channel_reply(bot, update):
             pass
 
     selected_channel = None
-    for channel in channel_handlers.values():
-        if channel.chat.title.lower() == channel_title.lower():
+    for channel in list(channel_handlers.values()):
+        if channel.chat.title.lower() == channel_title.lower() and serves(bot, channel):
             if channel_id is not None:
                 if channel.chat.id == channel_id:
                     selected_channel = channel
@@ -368,12 +706,12 @@ def select_channel_reply(bot, update):
         return
 
     # make sure user is admin in selected channel
-    if user_id not in [admin.user.id for admin in selected_channel.chat.get_administrators()]:
+    if user_id not in chat_cache.admin_ids(bot, selected_channel.chat.id):
         bot.send_message(chat_id=user_id, text="You are not an admin in %s!" % channel_title,
                          reply_markup=ReplyKeyboardRemove)
         return
 
-    config['focus_channels'][str(user_id)] = selected_channel.chat.id
+    bot_config(bot)['focus_channels'][str(user_id)] = selected_channel.chat.id
     bot.send_message(chat_id=user_id,
                      text="*You are now working with %s.*\n\nAny messages you send to me will be queued "
                           "for %s and any channel-specific commands will also target %s." % (
@@ -385,10 +723,10 @@ def select_channel_reply(bot, update):
 
 def message_received(bot, update):
     user_id = update.message.from_user.id
-    if user_id in config['waiting_for_channel_setup']:
+    if user_id in bot_config(bot)['waiting_for_channel_setup']:
         setup_channel(bot, update)
         return
-    if user_id in config['waiting_for_channel_select']:
+    if user_id in bot_config(bot)['waiting_for_channel_select']:
         select_channel_reply(bot, update)
         return
     add_content(bot, update)
@@ -410,40 +748,151 @@ def remove_post(bot, update):
     query = update.callback_query
     args = query.data.split('[&sp?]')
     post_id = int(args[2])
-    target_channel = channel_handlers[args[1]]
+    target_channel = channel_handlers.get(args[1])
+    if target_channel is None:
+        query.answer(text="That channel is still loading. Try again in a moment!")
+        return
     target_channel.remove_post(bot, update, post_id)
 
 
+def bulk_page(bot, update):
+    query = update.callback_query
+    args = query.data.split('[&sp?]')
+    target_channel = channel_handlers.get(args[1])
+    if target_channel is None:
+        query.answer(text="That channel is still loading. Try again in a moment!")
+        return
+    post_id = int(args[4]) if args[0] == 'bulk_rm' else None
+    target_channel.bulk_page(bot, update, int(args[2]), int(args[3]), post_id)
+
+
+def add_duplicate(bot, update):
+    query = update.callback_query
+    args = query.data.split('[&sp?]')
+    target_channel = channel_handlers.get(args[1])
+    if target_channel is None:
+        query.answer(text="That channel is still loading. Try again in a moment!")
+        return
+    target_channel.add_duplicate(bot, update, int(args[2]))
+
+
 def restart_bot(bot, update):
     if update.message.from_user.id in config['admins']:
         bot.send_message(chat_id=update.message.chat_id, text="Restarting bot...")
-        dump_data()
+        dump_data().wait()
         os.execl(sys.executable, sys.executable, *sys.argv)
 
 
+def profile_command(bot, update, args):
+    user_id = update.message.from_user.id
+    if user_id not in config['admins']:
+        bot.send_message(chat_id=update.message.chat_id, text="I didn't recognize that command!")
+        return
+    try:
+        duration = min(max(float(args[0]), 1), 120) if len(args) > 0 else 10
+    except ValueError:
+        bot.send_message(chat_id=update.message.chat_id, text="Follow /profile with the number of seconds to sample.")
+        return
+    if profiler.capture_lock.locked():
+        bot.send_message(chat_id=update.message.chat_id, text="A profile is already being captured.")
+        return
+    text = "Profiling for %gs..." % duration
+    if coordinator is not None:
+        # the sampler only sees this process's threads
+        text += " Only the main process is sampled, channel handlers running in the shard processes are not."
+    bot.send_message(chat_id=update.message.chat_id, text=text)
+
+    # sample on a separate thread so the dispatcher keeps handling updates while they are being profiled
+    def capture():
+        report = profiler.SamplingProfiler(config.get('profile_interval', 0.005)).capture(duration).report()
+        logger.info('Profile requested by %d:\n%s' % (user_id, report))
+        bot.send_message(chat_id=update.message.chat_id, text="```\n%s\n```" % report[:4000], parse_mode='Markdown')
+
+    threading.Thread(target=capture, name='profiler', daemon=True).start()
+
+
+def shards_command(bot, update, args):
+    user_id = update.message.from_user.id
+    if user_id not in config['admins']:
+        bot.send_message(chat_id=update.message.chat_id, text="I didn't recognize that command!")
+        return
+    if coordinator is None:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text="Sharding is off. Set `shards` in config.json and restart to turn it on.",
+                         parse_mode='Markdown')
+        return
+    if len(args) == 0:
+        bot.send_message(chat_id=update.message.chat_id, text="Running *%d* shards for *%d* channels." % (
+            coordinator.count, len(coordinator.assignment)), parse_mode='Markdown')
+        return
+    try:
+        count = int(args[0])
+    except ValueError:
+        count = 0
+    if not 1 <= count <= config.get('max_shards', 32):
+        bot.send_message(chat_id=update.message.chat_id, text="Follow /shards with the number of worker processes.")
+        return
+    moved = coordinator.resize(count)
+    config['shards'] = count
+    bot.send_message(chat_id=update.message.chat_id, text="Now running *%d* shards, *%d* channels moved." % (
+        count, moved), parse_mode='Markdown')
+
+
 def unknown_command(bot, update):
     bot.send_message(chat_id=update.message.chat_id, text="I didn't recognize that command!")
 
 
 def dump_data(bot=None, job=None, update=None):
-    for channel_handler in channel_handlers.values():
-        channel_handler.dump_data()
-    data = json.dumps(config)
-    dir = os.path.dirname(__file__)
-    path = os.path.join(dir, 'config.json')
-    with open(path, "w") as f:
-        f.write(data)
+    global config_writer
+    if config_writer is None:
+        dir = os.path.dirname(__file__)
+        config_writer = ConfigWriter(os.path.join(dir, 'config.json'))
+    channels = {}
+    for (channel_id, channel_handler) in list(channel_handlers.items()):
+        if channel_handler.dirty:
+            channels[channel_id] = channel_handler.dump_data()
+        else:
+            channel_handler.save_history()
+    if coordinator is not None:
+        channels.update(coordinator.dump_data())
+    for channel_id in list(config['channels']):
+        if channel_id not in channel_handlers:
+            channels[channel_id] = copy.deepcopy(config['channels'][channel_id])
+    global_data = {
+        'config': copy.deepcopy({key: value for (key, value) in config.items() if key != 'channels'}),
+        'channel_ids': set(config['channels']) | set(channel_handlers)
+    }
+    return config_writer.submit(global_data, channels)
 
 
 def update_admins(bot=None, job=None):
-    for handler in channel_handlers.values():
+    # titles, admins and memberships are looked up again on the periodic refresh
+    for channel_id in list(channel_handlers):
+        chat_cache.invalidate(int(channel_id))
+    if coordinator is not None:
+        coordinator.update_admins()
+        return
+    for handler in list(channel_handlers.values()):
         handler.update_admins()
 
 
+def log_send_stats(bot=None, job=None):
+    stats = send_scheduler.lag_stats()
+    if stats['count'] == 0:
+        return
+    logger.info('Post send lag over last %d sends: p50 %.1fs, p95 %.1fs, max %.1fs (%d RetryAfter, %d queued)' % (
+        stats['count'], stats['p50'], stats['p95'], stats['max'], send_scheduler.retry_after_count,
+        send_scheduler.backlog()))
+
+
 # logs bot errors thrown
 def error(bot, update, error):
+    metrics.inc('handler_errors_total', error=type(error).__name__)
     logger.warning('Update "%s" caused error "%s"' % (update, error))
 
 
 if __name__ == '__main__':
-    main()
+    # run from the imported module so the handlers and shard processes share its globals with this one
+    import channel_queue_bot
+
+    channel_queue_bot.main()
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+# Caches chat metadata from the Bot API for ttl seconds, per bot since hosted bots see chats differently.
+# Errors are never cached, so a lookup that failed (e.g. the bot isn't an admin yet) is retried on the next call.
+class ChatCache:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get_chat(self, bot, chat_id, refresh=False):
+        return self._get(('chat', chat_id, bot.token), lambda: bot.get_chat(chat_id=chat_id), refresh)
+
+    def get_administrators(self, bot, chat_id, refresh=False):
+        return self._get(('admins', chat_id, bot.token), lambda: bot.get_chat_administrators(chat_id=chat_id),
+                         refresh)
+
+    def admin_ids(self, bot, chat_id, refresh=False):
+        return [admin.user.id for admin in self.get_administrators(bot, chat_id, refresh) if not admin.user.is_bot]
+
+    def get_member(self, bot, chat_id, user_id, refresh=False):
+        return self._get(('member', chat_id, bot.token, user_id),
+                         lambda: bot.get_chat_member(chat_id=chat_id, user_id=user_id), refresh)
+
+    def invalidate(self, chat_id=None):
+        with self.lock:
+            if chat_id is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if key[1] == chat_id]:
+                del self.entries[key]
+
+    def _get(self, key, fetch, refresh):
+        now = time.time()
+        if not refresh:
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        value = fetch()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+        return value
@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Writes config.json on a background thread. Channel entries are serialized only when a fresh snapshot
+# of them is submitted; unchanged channels reuse the JSON fragment from the previous dump.
+class ConfigWriter:
+    def __init__(self, path):
+        self.path = path
+        self.fragments = {}
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, name='config-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, global_data, channels):
+        done = threading.Event()
+        self.jobs.put((global_data, channels, done))
+        return done
+
+    def _write_loop(self):
+        while True:
+            (global_data, channels, done) = self.jobs.get()
+            try:
+                self._write(global_data, channels)
+            except Exception as e:
+                logger.error("Failed to write %s: %s" % (self.path, e))
+            finally:
+                done.set()
+
+    def _write(self, global_data, channels):
+        start = time.time()
+        for (channel_id, channel_data) in channels.items():
+            self.fragments[channel_id] = json.dumps(channel_data)
+        for channel_id in list(self.fragments):
+            if channel_id not in global_data['channel_ids']:
+                del self.fragments[channel_id]
+        data = dict(global_data['config'])
+        data['channels'] = {}
+        # splice the cached channel fragments into the serialized config
+        head = json.dumps(data)[:-len('{}}')]
+        body = ', '.join('%s: %s' % (json.dumps(channel_id), fragment)
+                         for (channel_id, fragment) in self.fragments.items())
+        text = head + '{' + body + '}}'
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        metrics.observe('dump_data_seconds', time.time() - start)
+        metrics.set_value('dump_data_bytes', len(text))
+        logger.info("Dumped config in %.1fms (%d bytes, %d of %d channels serialized)" % (
+            (time.time() - start) * 1000, len(text), len(channels), len(self.fragments)))
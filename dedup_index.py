@@ -0,0 +1,157 @@
+import base64
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+DAY = 24 * 60 * 60
+# attributes of photo sizes, videos, audio, documents, stickers, voice and video notes that every copy shares
+MEDIA_ATTRIBUTES = ('file_size', 'width', 'height', 'duration', 'length', 'mime_type', 'file_name', 'performer',
+                    'title', 'set_name', 'emoji')
+
+
+def digest(kind, value):
+    return '%s:%s' % (kind, hashlib.sha1(value.encode('utf-8')).hexdigest()[:16])
+
+
+def text_digest(text):
+    # case and whitespace differences don't make a text new
+    return digest('t', ' '.join(text.lower().split()))
+
+
+def media_digest(media):
+    # file_unique_id is the same for every copy of a file. Older Bot API versions, and python-telegram-bot 10.x,
+    # only have file_id, which differs between forwarded copies, so the file's size and shape stand in for it.
+    # Different files alike in all of these are rare, and can still be queued anyway.
+    unique_id = getattr(media, 'file_unique_id', None)
+    if unique_id:
+        return digest('m', unique_id)
+    if getattr(media, 'file_size', None):
+        return digest('m', json.dumps([type(media).__name__] + [getattr(media, name, None)
+                                                                for name in MEDIA_ATTRIBUTES]))
+    return digest('m', media.file_id)
+
+
+def post_digest(post):
+    if post.digest is not None:
+        return post.digest
+    if post.type == 't':
+        return text_digest(post.payload)
+    return digest('m', post.payload)
+
+
+class BloomFilter:
+    __slots__ = ('size', 'hashes', 'bits')
+
+    def __init__(self, capacity, error_rate=0.001, bits=None):
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) // 8 * 8 + 8
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray(self.size // 8) if bits is None else bytearray(bits)
+
+    def positions(self, key):
+        # double hashing, k positions from two 64 bit halves of one digest
+        value = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        (first, second) = (int.from_bytes(value[:8], 'little'), int.from_bytes(value[8:], 'little') | 1)
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+# Digests of published posts in rolling windows of window_days, one fixed-size bloom filter per window. Once
+# the newest window is full of days a fresh one starts and the oldest is dropped, so memory stays bounded
+# and posts older than windows * window_days are forgotten.
+class PublishedHistory:
+    def __init__(self, path, window_days=30, windows=6, capacity=5000):
+        self.path = path
+        self.window_days = window_days
+        self.windows = windows
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.filters = []
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('capacity') == capacity:
+                self.filters = [(start, BloomFilter(capacity, bits=base64.b64decode(bits)))
+                                for (start, bits) in data['filters']][-windows:]
+
+    def rotate(self, now):
+        today = int(now // DAY)
+        if len(self.filters) == 0 or self.filters[-1][0] + self.window_days <= today:
+            self.filters.append((today, BloomFilter(self.capacity)))
+            self.filters = self.filters[-self.windows:]
+
+    def add(self, key, now=None):
+        with self.lock:
+            self.rotate(time.time() if now is None else now)
+            self.filters[-1][1].add(key)
+            self.dirty = True
+
+    def __contains__(self, key):
+        with self.lock:
+            return any(key in bloom for (_, bloom) in self.filters)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or self.path is None:
+                return
+            data = {'capacity': self.capacity,
+                    'filters': [(start, base64.b64encode(bytes(bloom.bits)).decode('ascii'))
+                                for (start, bloom) in self.filters]}
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Exact index of the queued posts' digests, for O(1) duplicate checks at enqueue time, plus the approximate
+# history of what has already been published. A digest maps to the ids of every queued post with it, in the
+# order they were added, since duplicates can be queued anyway.
+class DedupIndex:
+    def __init__(self, history=None):
+        self.history = history
+        self.lock = threading.Lock()
+        self.queued = {}
+
+    def rebuild(self, posts):
+        queued = {}
+        for post in posts:
+            queued.setdefault(post_digest(post), {})[post.id] = None
+        with self.lock:
+            self.queued = queued
+
+    def find(self, key):
+        # ('queued', post id) for a queued duplicate, ('published', None) if it probably went out already
+        with self.lock:
+            post_ids = self.queued.get(key)
+            if post_ids is not None:
+                return 'queued', next(iter(post_ids))
+        if self.history is not None and key in self.history:
+            return 'published', None
+        return None
+
+    def add(self, post):
+        key = post_digest(post)
+        with self.lock:
+            self.queued.setdefault(key, {})[post.id] = None
+
+    def discard(self, post):
+        key = post_digest(post)
+        with self.lock:
+            post_ids = self.queued.get(key)
+            if post_ids is not None and post_ids.pop(post.id, False) is None and len(post_ids) == 0:
+                del self.queued[key]
+
+    def published(self, post):
+        self.discard(post)
+        if self.history is not None:
+            self.history.add(post_digest(post))
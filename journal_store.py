@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from post_queue import QueuedPost, PostQueue
+
+logger = logging.getLogger(__name__)
+
+USERS_STREAM = 'users'
+
+
+def replay(config, records):
+    # fold journal records newer than the snapshot's sequence number into a channel config
+    queue = PostQueue(QueuedPost.from_data(data) for data in config.get('queued_posts', []))
+    seq = config.pop('seq', 0)
+    for record in records:
+        if record[0] <= seq:
+            continue
+        seq = record[0]
+        op = record[1]
+        if op == 'add_post':
+            queue.append(QueuedPost.from_data(record[2]))
+        elif op == 'remove_post':
+            queue.remove(record[2])
+        elif op == 'reorder':
+            queue.reorder([queue.get(post_id) for post_id in record[2] if post_id in queue])
+        elif op == 'add_time':
+            if record[2] not in config['post_times']:
+                config['post_times'].append(record[2])
+        elif op == 'remove_time':
+            if record[2] in config['post_times']:
+                config['post_times'].remove(record[2])
+        elif op == 'save_settings':
+            config.update(record[2])
+        elif op == 'set_timezone':
+            config.setdefault('timezone_prefs', {})[record[2]] = record[3]
+    if 'queued_posts' in config:
+        config['queued_posts'] = queue.to_data()
+    return seq
+
+
+def read_records(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # torn write at the tail of the journal, nothing after it was committed
+                break
+    return records
+
+
+class JournalStream:
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.journal_path = base_path + '.journal'
+        self.old_path = base_path + '.journal.old'
+        self.snapshot_path = base_path + '.snapshot'
+        self.lock = threading.Lock()
+        self.file = None
+        self.seq = 0
+        self.size = 0
+        self.compacting = False
+        self.released = False
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path)
+
+    def load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                config = json.load(f)
+        else:
+            config = {'seq': 0}
+        records = read_records(self.old_path) + read_records(self.journal_path)
+        seq = replay(config, records)
+        # only the first load moves seq forward, after that appends in flight are ahead of what is on disk
+        if seq > self.seq:
+            self.seq = seq
+        if os.path.exists(self.journal_path):
+            self.size = os.path.getsize(self.journal_path)
+        return config
+
+    def write(self, lines):
+        if self.file is None:
+            self.file = open(self.journal_path, 'ab')
+        data = b''.join(lines)
+        self.file.write(data)
+        self.size += len(data)
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def write_snapshot(self, config, seq):
+        data = dict(config)
+        data['seq'] = seq
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+    def compact(self):
+        try:
+            with self.lock:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                if not os.path.exists(self.old_path) and os.path.exists(self.journal_path):
+                    os.replace(self.journal_path, self.old_path)
+                self.size = 0
+            # folding runs without the lock so commits to the new journal go on meanwhile
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path) as f:
+                    config = json.load(f)
+            else:
+                config = {'seq': 0}
+            seq = replay(config, read_records(self.old_path))
+            # swapped under the lock, a load sees either the old snapshot and journal or the new snapshot
+            with self.lock:
+                self.write_snapshot(config, seq)
+                if os.path.exists(self.old_path):
+                    os.remove(self.old_path)
+        finally:
+            self.compacting = False
+
+
+# Append-only, per-channel mutation journal. Records are fsynced in group commits by a writer thread,
+# and a compactor folds journals that grow past compact_size into the channel's snapshot.
+class JournalStore:
+    def __init__(self, directory, commit_interval=0.01, compact_size=1 << 20):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.compact_size = compact_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.streams = {}
+        self.streams_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.committed = 0
+        self.compact_queue = []
+        self.running = True
+        self.writer = threading.Thread(target=self._write_loop, name='journal-writer', daemon=True)
+        self.writer.start()
+        self.compactor = threading.Thread(target=self._compact_loop, name='journal-compactor', daemon=True)
+        self.compactor.start()
+
+    def channel_ids(self):
+        channel_ids = set()
+        for name in os.listdir(self.directory):
+            stream_name = name.split('.')[0]
+            if stream_name != USERS_STREAM and (name.endswith('.snapshot') or name.endswith('.journal')):
+                channel_ids.add(stream_name)
+        return list(channel_ids)
+
+    def has_channel(self, channel_id):
+        return self._stream(channel_id).exists()
+
+    def load_channel(self, channel_id):
+        stream = self._stream(channel_id)
+        if not stream.exists():
+            return None
+        with stream.lock:
+            return stream.load()
+
+    def import_channel(self, channel_id, config, posts):
+        stream = self._stream(channel_id)
+        data = dict(config)
+        data['queued_posts'] = [post.to_data() for post in posts]
+        with stream.lock:
+            stream.write_snapshot(data, stream.seq)
+
+    def save_settings(self, channel_id, config):
+        settings = {key: value for (key, value) in config.items() if key not in ('queued_posts', 'post_times')}
+        self._append(channel_id, 'save_settings', settings)
+
+    def add_post(self, channel_id, post):
+        self._append(channel_id, 'add_post', post.to_data())
+
+    def remove_post(self, channel_id, post_id):
+        self._append(channel_id, 'remove_post', post_id)
+
+    def reorder(self, channel_id, posts):
+        self._append(channel_id, 'reorder', [post.id for post in posts])
+
+    def add_time(self, channel_id, time_string):
+        self._append(channel_id, 'add_time', time_string)
+
+    def remove_time(self, channel_id, time_string):
+        self._append(channel_id, 'remove_time', time_string)
+
+    def release_channel(self, channel_id):
+        # hands the channel's files to another process: its journal is closed and no longer compacted from here
+        with self.streams_lock:
+            stream = self.streams.pop(str(channel_id), None)
+        if stream is None:
+            return
+        with self.condition:
+            stream.released = True
+            if stream in self.compact_queue:
+                self.compact_queue.remove(stream)
+                stream.compacting = False
+        while stream.compacting:
+            time.sleep(0.01)
+        with stream.lock:
+            if stream.file is not None:
+                stream.file.close()
+                stream.file = None
+
+    def timezone_prefs(self):
+        stream = self._stream(USERS_STREAM)
+        with stream.lock:
+            config = stream.load()
+        return config.get('timezone_prefs', {})
+
+    def set_timezone(self, user_id, timezone):
+        stream = self._stream(USERS_STREAM)
+        if not stream.exists():
+            with stream.lock:
+                stream.write_snapshot({'timezone_prefs': {}}, stream.seq)
+        self._append(USERS_STREAM, 'set_timezone', str(user_id), timezone)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.writer.join()
+        for stream in self.streams.values():
+            with stream.lock:
+                if stream.file is not None:
+                    stream.file.close()
+                    stream.file = None
+
+    def _stream(self, name):
+        name = str(name)
+        with self.streams_lock:
+            if name not in self.streams:
+                self.streams[name] = JournalStream(os.path.join(self.directory, name))
+            return self.streams[name]
+
+    def _append(self, name, op, *args):
+        stream = self._stream(name)
+        with self.condition:
+            stream.seq += 1
+            line = json.dumps([stream.seq, op] + list(args)).encode('utf-8') + b'\n'
+            self.pending.append((stream, line))
+            self.appended += 1
+            ticket = self.appended
+            self.condition.notify_all()
+            # block until the group commit containing this record is on disk
+            while self.committed < ticket and self.running:
+                self.condition.wait()
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and self.running:
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    return
+            # give concurrent mutations a moment to join this commit
+            time.sleep(self.commit_interval)
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+                ticket = self.appended
+            by_stream = {}
+            for (stream, line) in batch:
+                by_stream.setdefault(stream, []).append(line)
+            for (stream, lines) in by_stream.items():
+                with stream.lock:
+                    stream.write(lines)
+                    stream.sync()
+                with self.condition:
+                    if stream.size > self.compact_size and not stream.compacting and not stream.released:
+                        stream.compacting = True
+                        self.compact_queue.append(stream)
+                        self.condition.notify_all()
+            with self.condition:
+                self.committed = ticket
+                self.condition.notify_all()
+
+    def _compact_loop(self):
+        while True:
+            with self.condition:
+                while len(self.compact_queue) == 0 and self.running:
+                    self.condition.wait()
+                if len(self.compact_queue) == 0:
+                    return
+                stream = self.compact_queue.pop(0)
+            try:
+                stream.compact()
+            except Exception:
+                # the journal is left in place and folded on the next compaction or load
+                logger.exception('Failed to compact %s' % stream.base_path)
@@ -0,0 +1,208 @@
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telegram import TelegramError
+from telegram.error import RetryAfter
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (name, value) in pairs)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for (index, bound) in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+# Counters, histograms and gauges rendered in the Prometheus text format. Gauges are callbacks evaluated at
+# render time, so values like queue depth cost nothing until someone looks at them. Sources add the series
+# of other processes, e.g. shard workers, under an extra label.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.values = {}
+        self.gauges = {}
+        self.sources = []
+
+    def inc(self, name, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def set_value(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[label_key(labels)] = value
+
+    def gauge(self, name, func):
+        # func returns a number, or a list of (labels dict, number) pairs
+        with self.lock:
+            self.gauges[name] = func
+
+    def add_source(self, func):
+        # func returns a list of (labels dict, collected) pairs, collected as returned by collect() elsewhere
+        with self.lock:
+            self.sources.append(func)
+
+    def collect(self):
+        # (counters, histograms, values) as plain dicts that pickle, with the gauges evaluated
+        with self.lock:
+            counters = dict((name, dict(series)) for (name, series) in self.counters.items())
+            histograms = dict((name, dict((key, (list(histogram.counts), histogram.sum, histogram.count))
+                                          for (key, histogram) in series.items()))
+                              for (name, series) in self.histograms.items())
+            values = dict((name, dict(series)) for (name, series) in self.values.items())
+            gauges = dict(self.gauges)
+            sources = list(self.sources)
+        for (name, func) in gauges.items():
+            value = func()
+            if isinstance(value, list):
+                values[name] = dict((label_key(labels), number) for (labels, number) in value)
+            else:
+                values[name] = {(): value}
+        for func in sources:
+            for (labels, collected) in func():
+                for (local, remote) in zip((counters, histograms, values), collected):
+                    for (name, series) in remote.items():
+                        target = local.setdefault(name, {})
+                        for (key, value) in series.items():
+                            target[label_key(dict(key, **labels))] = value
+        return counters, histograms, values
+
+    def render(self):
+        (counters, histograms, values) = self.collect()
+        lines = []
+        for (name, series) in sorted(counters.items()):
+            lines.append('# TYPE %s counter' % name)
+            for (key, value) in series.items():
+                lines.append('%s%s %s' % (name, format_labels(key), value))
+        for (name, series) in sorted(histograms.items()):
+            lines.append('# TYPE %s histogram' % name)
+            for (key, (counts, total, count)) in series.items():
+                cumulative = 0
+                for (bound, bucket) in zip(BUCKETS, counts):
+                    cumulative += bucket
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key, [('le', bound)]), cumulative))
+                lines.append('%s_bucket%s %d' % (name, format_labels(key, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %f' % (name, format_labels(key), total))
+                lines.append('%s_count%s %d' % (name, format_labels(key), count))
+        for (name, series) in sorted(values.items()):
+            lines.append('# TYPE %s gauge' % name)
+            for (key, value) in series.items():
+                lines.append('%s%s %s' % (name, format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+set_value = registry.set_value
+gauge = registry.gauge
+add_source = registry.add_source
+collect = registry.collect
+render = registry.render
+
+
+def timed(name, func, **labels):
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            registry.observe(name, time.time() - start, **labels)
+
+    return wrapped
+
+
+def record_api_call(method, start, error=None):
+    registry.observe('bot_api_seconds', time.time() - start, method=method)
+    registry.inc('bot_api_calls_total', method=method)
+    if isinstance(error, RetryAfter):
+        registry.inc('bot_api_errors_total', method=method, error='RetryAfter')
+    elif isinstance(error, TelegramError):
+        registry.inc('bot_api_errors_total', method=method, error=type(error).__name__)
+
+
+def instrument_bot(bot):
+    # every Bot API call of a telegram.Bot goes through its request object's post(). Bots hosted in one process
+    # share their request object, which is only wrapped once so calls aren't counted for every bot.
+    request = bot._request
+    post = request.post
+    if getattr(post, 'instrumented', False):
+        return
+
+    def instrumented_post(url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        start = time.time()
+        try:
+            result = post(url, *args, **kwargs)
+        except Exception as e:
+            record_api_call(method, start, e)
+            raise
+        record_api_call(method, start)
+        return result
+
+    instrumented_post.instrumented = True
+    request.post = instrumented_post
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, listen='0.0.0.0'):
+    server = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
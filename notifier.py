@@ -0,0 +1,62 @@
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Fans queue notices out to a channel's admins from its own thread, off the posting path. A notice is keyed by
+# channel and kind; once sent, the same alert is dropped until the condition clears or interval seconds have
+# passed, so an empty queue alerts once rather than at every slot.
+class Notifier:
+    def __init__(self, interval=24 * 60 * 60, queue_size=1000):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.notices = queue.Queue(maxsize=queue_size)
+        self.thread = None
+
+    def notify(self, channel_id, kind, send, admin_ids, text):
+        # send(admin_id, text) is called for every admin, returns whether the notice went out
+        key = (channel_id, kind)
+        now = time.time()
+        with self.lock:
+            if key in self.sent and now - self.sent[key] < self.interval:
+                metrics.inc('notices_coalesced_total', kind=kind)
+                return False
+            self.sent[key] = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+                self.thread.start()
+        try:
+            self.notices.put_nowait((send, list(admin_ids), text))
+        except queue.Full:
+            logger.warning('Notice queue full, dropped "%s"' % text)
+            # not sent, so the next occurrence may try again
+            with self.lock:
+                if self.sent.get(key) == now:
+                    del self.sent[key]
+            return False
+        return True
+
+    def clear(self, channel_id, kind):
+        with self.lock:
+            self.sent.pop((channel_id, kind), None)
+
+    def backlog(self):
+        return self.notices.qsize()
+
+    def _run(self):
+        while True:
+            (send, admin_ids, text) = self.notices.get()
+            for admin_id in admin_ids:
+                try:
+                    send(admin_id, text)
+                except Exception as e:
+                    logger.warning('Failed to notify %s: %s' % (admin_id, e))
+                    continue
+                # send hands the notice to the send scheduler, delivery failures are logged there
+                metrics.inc('notices_submitted_total')
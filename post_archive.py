@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+DAY = 24 * 60 * 60
+
+
+def day_string(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def content_hash(text):
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+# Append-only record of a channel's published posts. Records are [timestamp, type, file id, caption hash,
+# message id] rows, buffered in memory and appended as gzip members to one file per month, so old months
+# are never rewritten. A per-day count of posts by type is kept next to them in summary.json, which is all
+# /stats needs; the monthly files are an export and the bot never reads them back. Buffered records are written
+# when the buffer fills and by every dump_data and the dump at shutdown, so a crash or kill loses at most the
+# posts published since the last dump (15 minutes) or buffer_size of them, whichever is fewer.
+class PostArchive:
+    def __init__(self, directory, buffer_size=100):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.summary_path = os.path.join(directory, 'summary.json')
+        self.days = {}
+        if os.path.exists(self.summary_path):
+            with open(self.summary_path) as f:
+                self.days = json.load(f)['days']
+
+    def append(self, timestamp, type, file_id, caption, message_id):
+        record = [int(timestamp), type, file_id, content_hash(caption), message_id]
+        with self.lock:
+            self.buffer.append(record)
+            counts = self.days.setdefault(day_string(timestamp), {})
+            counts[type] = counts.get(type, 0) + 1
+            full = len(self.buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            (records, self.buffer) = (self.buffer, [])
+            summary = {'days': {day: dict(counts) for (day, counts) in self.days.items()}}
+        if len(records) == 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        partitions = {}
+        for record in records:
+            partitions.setdefault(time.strftime('%Y-%m', time.gmtime(record[0])), []).append(record)
+        for (month, rows) in partitions.items():
+            data = ''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8')
+            # gzip files may hold several members back to back, each flush appends one
+            with open(os.path.join(self.directory, '%s.jsonl.gz' % month), 'ab') as f:
+                f.write(gzip.compress(data))
+        with open(self.summary_path + '.tmp', 'w') as f:
+            json.dump(summary, f)
+        os.replace(self.summary_path + '.tmp', self.summary_path)
+
+    def counts(self, start, end):
+        # {day: {type: count}} for the days from start up to end, timestamps in seconds
+        counts = {}
+        day = start - start % DAY
+        with self.lock:
+            while day <= end:
+                if day_string(day) in self.days:
+                    counts[day_string(day)] = dict(self.days[day_string(day)])
+                day += DAY
+        return counts
@@ -0,0 +1,124 @@
+import threading
+from collections import deque
+
+
+class QueuedPost:
+    __slots__ = ('id', 'type', 'payload', 'caption', 'group', 'admin', 'digest')
+
+    def __init__(self, post_id, type, payload, caption=None, group=None, admin=None, digest=None):
+        self.id = post_id
+        self.type = type
+        self.payload = payload
+        self.caption = caption
+        # media_group_id of the album the post was forwarded in
+        self.group = group
+        # user id of the admin who queued the post
+        self.admin = admin
+        # content hash used for duplicate detection
+        self.digest = digest
+
+    def to_data(self):
+        # optional trailing fields are left off while unset, so older records keep their four fields
+        data = [self.id, self.type, self.payload, self.caption, self.group, self.admin, self.digest]
+        while len(data) > 4 and data[-1] is None:
+            data.pop()
+        return data
+
+    @classmethod
+    def from_data(cls, data):
+        if isinstance(data, str):
+            # legacy "index:type:payload[:caption]" entries with colons escaped as &cl
+            args = data.split(':', 3)
+            caption = None
+            if len(args) > 3:
+                caption = args[3].replace('&cl', ':')
+            return cls(int(args[0]), args[1], args[2].replace('&cl', ':'), caption)
+        return cls(*data)
+
+
+# FIFO of QueuedPost records with O(1) append, popleft and remove by post id. Removed posts stay
+# in the deque as stale entries until they reach the front or outnumber the live posts.
+class PostQueue:
+    def __init__(self, posts=()):
+        self._lock = threading.RLock()
+        self._posts = deque()
+        self._index = {}
+        self._stale = 0
+        self.next_id = 1
+        for post in posts:
+            self.append(post)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        # iterate a snapshot, other threads append and pop while queue listings are built
+        with self._lock:
+            posts = list(self._posts)
+            index = self._index
+        for post in posts:
+            if index.get(post.id) is post:
+                yield post
+
+    def __contains__(self, post_id):
+        return post_id in self._index
+
+    def get(self, post_id):
+        return self._index.get(post_id)
+
+    def append(self, post):
+        with self._lock:
+            if post.id in self._index:
+                self.remove(post.id)
+            self._posts.append(post)
+            self._index[post.id] = post
+            self.next_id = max(self.next_id, post.id + 1)
+
+    def remove(self, post_id):
+        with self._lock:
+            post = self._index.pop(post_id, None)
+            if post is None:
+                return None
+            self._stale += 1
+            if self._stale > 64 and self._stale > len(self._index):
+                self.reorder(list(self))
+            return post
+
+    def peek(self):
+        with self._lock:
+            self._drop_stale()
+            if len(self._posts) == 0:
+                return None
+            return self._posts[0]
+
+    def popleft(self):
+        with self._lock:
+            self._drop_stale()
+            post = self._posts.popleft()
+            del self._index[post.id]
+            return post
+
+    def reorder(self, posts):
+        # posts is a new order for a snapshot of the queue. Posts removed since the snapshot stay removed and
+        # posts added since then keep their place at the end, so the result is the same whatever interleaves.
+        with self._lock:
+            index = self._index
+            ordered = deque(post for post in posts if index.get(post.id) is post)
+            if len(ordered) < len(index):
+                seen = set(post.id for post in ordered)
+                ordered.extend(post for post in self if post.id not in seen)
+            self._posts = ordered
+            self._index = {post.id: post for post in ordered}
+            self._stale = 0
+            return list(ordered)
+
+    def to_data(self):
+        with self._lock:
+            posts = list(self._posts)
+            index = self._index
+        return [post.to_data() for post in posts if index.get(post.id) is post]
+
+    def _drop_stale(self):
+        while self._stale > 0 and len(self._posts) > 0 and self._index.get(self._posts[0].id) is not self._posts[0]:
+            self._posts.popleft()
+            self._stale -= 1
@@ -0,0 +1,124 @@
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+def to_minutes(time_string):
+    (hour, minute) = time_string.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def next_fire_time(minute, now):
+    fire_time = now - now % DAY + minute * 60
+    if fire_time <= now:
+        fire_time += DAY
+    return fire_time
+
+
+def to_time_string(minute):
+    return '%d:%02d' % (minute // 60, minute % 60)
+
+
+# A channel's daily post times as sorted minutes of the day. Membership and the next slot after a moment are
+# bisect lookups, and the fire times of the next n slots follow arithmetically from the sorted list.
+class ScheduleIndex:
+    def __init__(self, minutes=()):
+        self.minutes = sorted(set(minutes))
+
+    def __len__(self):
+        return len(self.minutes)
+
+    def __iter__(self):
+        return iter(self.minutes)
+
+    def __contains__(self, minute):
+        index = bisect_left(self.minutes, minute)
+        return index < len(self.minutes) and self.minutes[index] == minute
+
+    def add(self, minute):
+        if minute in self:
+            return False
+        insort(self.minutes, minute)
+        return True
+
+    def remove(self, minute):
+        if minute not in self:
+            return False
+        del self.minutes[bisect_left(self.minutes, minute)]
+        return True
+
+    def slot_times(self, now, count):
+        # fire times of the next count slots strictly after now
+        if len(self.minutes) == 0:
+            return []
+        day_start = now - now % DAY
+        first = bisect_right(self.minutes, (now - day_start) // 60)
+        (minutes, size) = (self.minutes, len(self.minutes))
+        return [day_start + (slot // size) * DAY + minutes[slot % size] * 60 for slot in range(first, first + count)]
+
+
+# One timer thread for every channel's daily post times. Slots sit in a min-heap keyed by their next fire
+# time; removed slots are dropped lazily when they reach the top. All slots due at the same moment are
+# popped and fired as one batch.
+class PostScheduler:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.slots = {}
+        self.generation = 0
+        self.thread = None
+
+    def add(self, channel, minute):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='post-scheduler', daemon=True)
+                self.thread.start()
+            self.generation += 1
+            key = (channel.channel_id, minute)
+            self.slots[key] = (channel, self.generation)
+            heapq.heappush(self.heap, (next_fire_time(minute, time.time()), self.generation, key))
+            self.condition.notify()
+
+    def remove(self, channel_id, minute):
+        with self.condition:
+            return self.slots.pop((channel_id, minute), None) is not None
+
+    def remove_channel(self, channel_id):
+        with self.condition:
+            for key in [key for key in self.slots if key[0] == channel_id]:
+                del self.slots[key]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.heap) == 0 or self.heap[0][0] > time.time():
+                    if len(self.heap) == 0:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(self.heap[0][0] - time.time())
+                fire_time = self.heap[0][0]
+                batch = []
+                while len(self.heap) > 0 and self.heap[0][0] == fire_time:
+                    (_, generation, key) = heapq.heappop(self.heap)
+                    slot = self.slots.get(key)
+                    if slot is None or slot[1] != generation:
+                        continue
+                    batch.append(slot[0])
+                    next_time = fire_time + DAY
+                    while next_time <= time.time():
+                        next_time += DAY
+                    heapq.heappush(self.heap, (next_time, generation, key))
+            for channel in batch:
+                try:
+                    channel.push_post(channel.bot, None, fire_time)
+                except Exception as e:
+                    logger.error('Scheduled post for %s failed: %s' % (channel.channel_id, e))
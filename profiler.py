@@ -0,0 +1,114 @@
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+import metrics
+
+# timing hooks only measure while this is set, when unset a hooked call costs one global lookup
+enabled = False
+hook_stats = {}
+hook_lock = threading.Lock()
+capture_lock = threading.Lock()
+
+
+def hook(name, func):
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.time() - start)
+
+    return wrapped
+
+
+def record(name, seconds):
+    metrics.observe('hook_seconds', seconds, hook=name)
+    with hook_lock:
+        stats = hook_stats.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def instrument(cls):
+    # hooks every method defined on cls, callers holding the class see the hooked versions
+    for (name, attribute) in list(vars(cls).items()):
+        if callable(attribute) and not name.startswith('__'):
+            setattr(cls, name, hook('%s.%s' % (cls.__name__, name), attribute))
+    return cls
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%d(%s)' % (code.co_filename.rsplit('/', 1)[-1], code.co_firstlineno, code.co_name)
+
+
+# Statistical profiler for the live process: samples the stack of every thread at a fixed interval and counts
+# each function once per sample it appears in (cumulative) and when it is the running frame (own).
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = 0
+        self.cumulative = Counter()
+        self.own = Counter()
+
+    def capture(self, duration):
+        global enabled
+        with capture_lock:
+            was_enabled = enabled
+            enabled = True
+            with hook_lock:
+                hooks_before = {name: list(stats) for (name, stats) in hook_stats.items()}
+            try:
+                self._sample(duration)
+            finally:
+                enabled = was_enabled
+            with hook_lock:
+                self.hooks = {}
+                for (name, (count, total)) in hook_stats.items():
+                    (previous_count, previous_total) = hooks_before.get(name, (0, 0.0))
+                    if count > previous_count:
+                        self.hooks[name] = (count - previous_count, total - previous_total)
+        return self
+
+    def _sample(self, duration):
+        own_thread = threading.get_ident()
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                self.stacks += 1
+                self.own[frame_name(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    name = frame_name(frame)
+                    if name not in seen:
+                        seen.add(name)
+                        self.cumulative[name] += 1
+                    frame = frame.f_back
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def report(self, limit=15):
+        # percentages are of all sampled thread stacks, own percentages add up to 100 across threads
+        lines = ['%d samples every %dms, %d thread stacks' % (self.samples, self.interval * 1000, self.stacks)]
+        if self.stacks == 0:
+            return lines[0]
+        lines.append('')
+        lines.append('cum%   own%   function')
+        for (name, count) in self.cumulative.most_common(limit):
+            lines.append('%5.1f  %5.1f   %s' % (count * 100.0 / self.stacks, self.own[name] * 100.0 / self.stacks,
+                                                name))
+        if len(self.hooks) > 0:
+            lines.append('')
+            lines.append('calls  total ms   hook')
+            for (name, (count, total)) in sorted(self.hooks.items(), key=lambda item: -item[1][1])[:limit]:
+                lines.append('%5d  %8.1f   %s' % (count, total * 1000, name))
+        return '\n'.join(lines)
@@ -0,0 +1,193 @@
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_POST = 0
+PRIORITY_NOTICE = 1
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def take(self, now):
+        # returns 0 if a token was taken, otherwise the seconds until one is available
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SendJob:
+    __slots__ = ('func', 'chat_id', 'kwargs', 'priority', 'scheduled', 'future', 'retries')
+
+    def __init__(self, func, chat_id, kwargs, priority, scheduled):
+        self.func = func
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.scheduled = scheduled
+        self.future = Future()
+        self.retries = 0
+
+
+# Central outbound queue for Bot API sends. A token bucket per bot keeps each hosted bot under Telegram's
+# overall flood limit and a bucket per chat keeps bursts to one chat apart. Sends to a chat stay in order, channel
+# posts go before admin notices, and RetryAfter errors pause the chat for the requested time.
+class SendScheduler:
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3, workers=8, max_retries=5):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.chats = {}
+        self.buckets = {}
+        # ready chats and the flood limit bucket of each bot token, so one busy bot can't hold up the others
+        self.ready = {}
+        self.bot_buckets = {}
+        self.sleeping = []
+        self.in_flight = set()
+        self.seq = 0
+        self.lags = deque(maxlen=1000)
+        self.retry_after_count = 0
+        self.thread = None
+        # set to an AsyncRuntime to perform sends as coroutines on its event loop instead of worker threads
+        self.runtime = None
+
+    def submit(self, func, chat_id, priority=PRIORITY_POST, scheduled=None, **kwargs):
+        job = SendJob(func, chat_id, kwargs, priority, scheduled)
+        with self.condition:
+            if self.thread is None:
+                self.start()
+            if chat_id not in self.chats:
+                self.chats[chat_id] = deque()
+            self.chats[chat_id].append(job)
+            if len(self.chats[chat_id]) == 1 and chat_id not in self.in_flight:
+                self._push_ready(chat_id)
+            self.condition.notify()
+        return job.future
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.thread = threading.Thread(target=self._schedule_loop, name='send-scheduler', daemon=True)
+        self.thread.start()
+
+    def backlog(self):
+        with self.condition:
+            return sum(len(jobs) for jobs in self.chats.values())
+
+    def lag_stats(self):
+        lags = sorted(self.lags)
+        if len(lags) == 0:
+            return {'count': 0}
+        return {'count': len(lags), 'p50': lags[len(lags) // 2], 'p95': lags[int(len(lags) * 0.95)],
+                'max': lags[-1]}
+
+    def _push_ready(self, chat_id):
+        self.seq += 1
+        job = self.chats[chat_id][0]
+        sender = getattr(getattr(job.func, '__self__', None), 'token', None)
+        if sender not in self.ready:
+            self.ready[sender] = []
+            self.bot_buckets[sender] = TokenBucket(self.rate, self.rate)
+        heapq.heappush(self.ready[sender], (job.priority, self.seq, chat_id))
+
+    def _schedule_loop(self):
+        while True:
+            with self.condition:
+                now = time.time()
+                while len(self.sleeping) > 0 and self.sleeping[0][0] <= now:
+                    (_, chat_id) = heapq.heappop(self.sleeping)
+                    self._push_ready(chat_id)
+                ready = sorted((heap[0], sender) for (sender, heap) in self.ready.items() if len(heap) > 0)
+                if len(ready) == 0:
+                    timeout = None
+                    if len(self.sleeping) > 0:
+                        timeout = self.sleeping[0][0] - now
+                    self.condition.wait(timeout)
+                    continue
+                # the most urgent chat among the bots that are under their flood limit
+                wait = None
+                for ((_, _, chat_id), sender) in ready:
+                    delay = self.bot_buckets[sender].take(now)
+                    if delay == 0:
+                        break
+                    wait = delay if wait is None else min(wait, delay)
+                else:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.ready[sender])
+                if chat_id not in self.buckets:
+                    self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                wait = self.buckets[chat_id].take(now)
+                if wait > 0:
+                    # hand the bot's token back, another chat can use it
+                    self.bot_buckets[sender].tokens += 1
+                    heapq.heappush(self.sleeping, (now + wait, chat_id))
+                    continue
+                job = self.chats[chat_id][0]
+                self.in_flight.add(chat_id)
+            if self.runtime is not None:
+                self._send_async(job)
+            else:
+                self.executor.submit(self._send, job)
+
+    def _send(self, job):
+        try:
+            result = job.func(chat_id=job.chat_id, **job.kwargs)
+        except Exception as e:
+            self._complete(job, error=e)
+            return
+        self._complete(job, result)
+
+    def _send_async(self, job):
+        future = self.runtime.submit(job.func, chat_id=job.chat_id, **job.kwargs)
+        future.add_done_callback(lambda done: self._complete(job, None if done.exception() else done.result(),
+                                                             done.exception()))
+
+    def _complete(self, job, result=None, error=None):
+        with self.condition:
+            self.in_flight.discard(job.chat_id)
+            if isinstance(error, RetryAfter):
+                self.retry_after_count += 1
+                if job.retries < self.max_retries:
+                    job.retries += 1
+                    logger.warning('Flood limit hit for chat %s, retrying in %ss' % (job.chat_id, error.retry_after))
+                    heapq.heappush(self.sleeping, (time.time() + error.retry_after, job.chat_id))
+                    self.condition.notify()
+                    return
+            elif error is None and job.scheduled is not None:
+                self.lags.append(time.time() - job.scheduled)
+                metrics.observe('post_delay_seconds', time.time() - job.scheduled)
+            self._finish(job)
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    def _finish(self, job):
+        jobs = self.chats[job.chat_id]
+        jobs.popleft()
+        if len(jobs) == 0:
+            del self.chats[job.chat_id]
+        else:
+            self._push_ready(job.chat_id)
+        self.condition.notify()
@@ -0,0 +1,421 @@
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import Bot, Chat, Update
+
+import channel_queue_bot
+import metrics
+from async_runtime import AsyncBot, NonBlockingBot
+
+logger = logging.getLogger(__name__)
+
+BOT = '__bot__'
+UPDATE = '__update__'
+# a shard that stayed up this long before exiting starts over with a short backoff
+RESTART_RESET = 300
+RESTART_BACKOFF_MAX = 60
+
+
+def weight(channel_id, worker):
+    return hashlib.md5(('%s:%s' % (channel_id, worker)).encode('utf-8')).digest()
+
+
+def owner(channel_id, workers):
+    # rendezvous hashing: when a worker is added or removed, only the channels it gains or loses move
+    return max(workers, key=lambda worker: weight(channel_id, worker))
+
+
+def encode(args):
+    # the bot is replaced by the worker's own, updates travel as their JSON dicts
+    encoded = []
+    for value in args:
+        if isinstance(value, (Bot, AsyncBot, NonBlockingBot)):
+            value = BOT
+        elif isinstance(value, Update):
+            value = (UPDATE, value.to_dict())
+        encoded.append(value)
+    return encoded
+
+
+def decode(args, bot):
+    decoded = []
+    for value in args:
+        if value == BOT:
+            value = bot
+        elif isinstance(value, tuple) and len(value) == 2 and value[0] == UPDATE:
+            value = Update.de_json(value[1], bot)
+        decoded.append(value)
+    return decoded
+
+
+def user_state(args, config):
+    # the coordinator owns user settings, workers get the time zone of the user they are answering
+    for value in args:
+        if isinstance(value, Update) and value.effective_user is not None:
+            user_id = str(value.effective_user.id)
+            if user_id in config['timezone_prefs']:
+                return {user_id: config['timezone_prefs'][user_id]}
+    return {}
+
+
+def describe(handler):
+    return {'id': handler.channel_id, 'title': handler.chat.title, 'admins': list(handler.config['admins']),
+            'bot_id': handler.config.get('bot_id'), 'queued': len(handler.queue)}
+
+
+class RemoteQueue:
+    __slots__ = ('length',)
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+# Stands in for a ChannelInstanceHandler living in a worker process. Title, admins and queue length are
+# cached from the last reply so listing channels needs no round trip, every other method call is forwarded
+# to the worker that owns the channel and blocks until it returns.
+class RemoteChannel:
+    dirty = False
+
+    def __init__(self, coordinator, entry):
+        self.coordinator = coordinator
+        self.channel_id = entry['id']
+        self.refresh(entry)
+
+    def refresh(self, entry):
+        self.chat = Chat(entry['id'], 'channel', title=entry['title'])
+        self.config = {'admins': entry['admins']}
+        if entry['bot_id'] is not None:
+            self.config['bot_id'] = entry['bot_id']
+        self.queue = RemoteQueue(entry['queued'])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.coordinator.call(self.channel_id, name, args, kwargs)
+
+        return call
+
+
+class WorkerClient:
+    def __init__(self, index, config, channel_ids, on_exit):
+        self.index = index
+        self.on_exit = on_exit
+        self.stopping = False
+        self.started = time.time()
+        context = multiprocessing.get_context('spawn')
+        (self.connection, child) = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(index, config, channel_ids, child),
+                                       name='shard-%d' % index, daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.thread = threading.Thread(target=self.receive, name='shard-%d-receiver' % index, daemon=True)
+        self.thread.start()
+
+    def submit(self, *message):
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            try:
+                self.connection.send((request_id,) + message)
+            except (OSError, ValueError) as e:
+                del self.pending[request_id]
+                future.set_exception(RuntimeError('Shard %d is gone: %s' % (self.index, e)))
+        return future
+
+    def request(self, *message, timeout=120):
+        return self.submit(*message).result(timeout)
+
+    def receive(self):
+        while True:
+            try:
+                (request_id, ok, value) = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+        with self.lock:
+            (pending, self.pending) = (self.pending, {})
+        for future in pending.values():
+            future.set_exception(RuntimeError('Shard %d exited' % self.index))
+        if not self.stopping:
+            self.on_exit(self)
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.request('stop', timeout=30)
+        except Exception:
+            pass
+        self.connection.close()
+        self.process.join(30)
+
+
+# Runs each channel's handler in one of several worker processes, so a slow channel or a large dump only
+# holds up the channels sharing its process. The coordinator keeps the update stream, the user commands and
+# config.json; channels are assigned to workers by rendezvous hashing of their id and move between workers
+# when the number of workers changes.
+class ShardCoordinator:
+    def __init__(self, config, workers):
+        self.config = config
+        self.count = workers
+        self.lock = threading.RLock()
+        self.workers = {}
+        self.assignment = {}
+        # exits in a row per shard index, for the restart backoff
+        self.crashes = {}
+
+    def worker_config(self):
+        data = dict(self.config)
+        # every worker sends from the same token, the global send rate is split between them
+        data['send_rate'] = max(1, self.config.get('send_rate', 30) // self.count)
+        return data
+
+    def start(self, channel_ids):
+        with self.lock:
+            groups = {index: [] for index in range(self.count)}
+            for channel_id in channel_ids:
+                groups[owner(str(channel_id), groups)].append(str(channel_id))
+            for (index, group) in groups.items():
+                self.spawn(index, group)
+            threading.Thread(target=self.wait_for_channels, name='shard-bootstrap', daemon=True).start()
+
+    def spawn(self, index, channel_ids):
+        self.workers[index] = WorkerClient(index, self.worker_config(), channel_ids, self.restart)
+        for channel_id in channel_ids:
+            self.assignment[channel_id] = index
+
+    def wait_for_channels(self):
+        for worker in list(self.workers.values()):
+            try:
+                self.refresh(worker.request('ready', timeout=None))
+            except Exception as e:
+                logger.error('Shard %d failed to start: %s' % (worker.index, e))
+
+    def refresh(self, entries):
+        for entry in entries:
+            channel_id = str(entry['id'])
+            handler = channel_queue_bot.channel_handlers.get(channel_id)
+            if isinstance(handler, RemoteChannel):
+                handler.refresh(entry)
+            else:
+                channel_queue_bot.channel_handlers[channel_id] = RemoteChannel(self, entry)
+
+    def call(self, channel_id, method, args, kwargs=None):
+        channel_id = str(channel_id)
+        kwargs = kwargs or {}
+        with self.lock:
+            worker = self.workers[self.assignment[channel_id]]
+        (result, entry) = worker.request('call', channel_id, method, encode(args),
+                                         dict(zip(kwargs, encode(kwargs.values()))),
+                                         user_state(list(args) + list(kwargs.values()), self.config))
+        if entry is not None:
+            self.refresh([entry])
+        return result
+
+    def add_channel(self, channel_id, data=None):
+        channel_id = str(channel_id)
+        with self.lock:
+            index = owner(channel_id, self.workers)
+            self.assignment[channel_id] = index
+            self.load(index, channel_id, data)
+        return channel_queue_bot.channel_handlers[channel_id]
+
+    def load(self, index, channel_id, data):
+        (entry, data) = self.workers[index].request('load', channel_id, data)
+        # a worker that crashes before the next dump is restarted from this
+        self.config['channels'][channel_id] = data
+        self.refresh([entry])
+
+    def each(self, *message):
+        # results of the workers that answered, a shard that is down or restarting is skipped
+        with self.lock:
+            futures = [(worker.index, worker.submit(*message)) for worker in self.workers.values()]
+        results = []
+        for (index, future) in futures:
+            try:
+                results.append(future.result(300))
+            except Exception as e:
+                logger.warning('Shard %d failed on %s: %s' % (index, message[0], e))
+        return results
+
+    def dump_data(self):
+        channels = {}
+        for result in self.each('dump'):
+            channels.update(result)
+        # keep the coordinator's copy current, restarted workers load their channels from it
+        with self.lock:
+            self.config['channels'].update(channels)
+        return channels
+
+    def collect_metrics(self):
+        # the workers' own series, labelled by shard, since their channels send and queue there
+        return [({'shard': index}, collected) for (index, collected) in self.each('metrics')]
+
+    def update_admins(self):
+        for entries in self.each('update_admins'):
+            self.refresh(entries)
+
+    def resize(self, count):
+        # returns how many channels moved to another worker
+        with self.lock:
+            self.count = count
+            for index in range(count):
+                if index not in self.workers:
+                    self.spawn(index, [])
+            targets = list(range(count))
+            moves = [(channel_id, index, owner(channel_id, targets))
+                     for (channel_id, index) in self.assignment.items() if index != owner(channel_id, targets)]
+            for (channel_id, source, target) in moves:
+                data = self.workers[source].request('release', channel_id)
+                if data is not None:
+                    self.config['channels'][channel_id] = data
+                self.assignment[channel_id] = target
+                self.load(target, channel_id, data)
+            for index in [index for index in self.workers if index >= count]:
+                self.workers.pop(index).stop()
+            logger.info('Resized to %d shards, %d channels moved' % (count, len(moves)))
+            return len(moves)
+
+    def channels_of(self, index):
+        return [channel_id for (channel_id, assigned) in self.assignment.items() if assigned == index]
+
+    def restart(self, worker):
+        index = worker.index
+        with self.lock:
+            if self.workers.get(index) is not worker:
+                return
+            if time.time() - worker.started > RESTART_RESET:
+                self.crashes[index] = 0
+            self.crashes[index] = self.crashes.get(index, 0) + 1
+            crashes = self.crashes[index]
+            channel_ids = self.channels_of(index)
+            if crashes > self.config.get('shard_restarts', 5):
+                # the channels stay in config.json and are tried again when the bot restarts
+                logger.error('Shard %d exited %d times in a row, giving up on its channels %s' % (
+                    index, crashes, ', '.join(channel_ids)))
+                del self.workers[index]
+                for channel_id in channel_ids:
+                    del self.assignment[channel_id]
+                    channel_queue_bot.channel_handlers.pop(channel_id, None)
+                return
+        delay = min(RESTART_BACKOFF_MAX, 2 ** (crashes - 1))
+        logger.error('Shard %d exited, restarting it in %ds' % (index, delay))
+        time.sleep(delay)
+        with self.lock:
+            if self.workers.get(index) is not worker:
+                return
+            channel_ids = self.channels_of(index)
+            if channel_queue_bot.store is None:
+                logger.warning('Shard %d restarts from the last dump, later changes to its %d channels are lost' % (
+                    index, len(channel_ids)))
+            self.spawn(index, channel_ids)
+            worker = self.workers[index]
+        try:
+            self.refresh(worker.request('ready', timeout=None))
+        except Exception as e:
+            # a shard that exits again while starting is restarted by its own exit
+            logger.error('Shard %d failed to start: %s' % (index, e))
+
+    def stop(self):
+        with self.lock:
+            for worker in self.workers.values():
+                worker.stop()
+            self.workers = {}
+
+
+def worker_main(index, config, channel_ids, connection):
+    channel_queue_bot.start_worker(config, channel_ids)
+    executor = ThreadPoolExecutor(max_workers=config.get('shard_threads', 4))
+    lock = threading.Lock()
+    handlers = channel_queue_bot.channel_handlers
+
+    def reply(request_id, ok, value):
+        with lock:
+            connection.send((request_id, ok, value))
+
+    def serve(message):
+        (request_id, kind, args) = (message[0], message[1], message[2:])
+        try:
+            reply(request_id, True, handle(kind, *args))
+        except Exception as e:
+            logger.exception('Shard %d failed on %s' % (index, kind))
+            reply(request_id, False, '%s: %s' % (type(e).__name__, e))
+
+    def handle(kind, *args):
+        if kind == 'call':
+            (channel_id, method, call_args, call_kwargs, prefs) = args
+            config['timezone_prefs'].update(prefs)
+            handler = handlers[channel_id]
+            call_kwargs = dict(zip(call_kwargs, decode(call_kwargs.values(), handler.bot)))
+            result = getattr(handler, method)(*decode(call_args, handler.bot), **call_kwargs)
+            return result, describe(handler)
+        if kind == 'ready':
+            channel_queue_bot.wait_for_channels()
+            return [describe(handler) for handler in list(handlers.values())]
+        if kind == 'dump':
+            data = {}
+            for (channel_id, handler) in list(handlers.items()):
+                if handler.dirty:
+                    data[channel_id] = handler.dump_data()
+                else:
+                    handler.save_history()
+            return data
+        if kind == 'metrics':
+            return index, metrics.collect()
+        if kind == 'update_admins':
+            channel_queue_bot.update_admins()
+            return [describe(handler) for handler in list(handlers.values())]
+        if kind == 'load':
+            (channel_id, data) = args
+            if data is not None:
+                config['channels'][channel_id] = data
+            handler = channel_queue_bot.connect_channel(channel_id)
+            return describe(handler), handler.dump_data()
+        if kind == 'release':
+            handler = handlers.pop(args[0])
+            channel_queue_bot.post_scheduler.remove_channel(handler.channel_id)
+            data = handler.dump_data()
+            if channel_queue_bot.store is not None:
+                # the target worker opens the channel's storage next, this process must be done with it
+                channel_queue_bot.store.release_channel(handler.channel_id)
+            return data
+        raise ValueError('Unknown request %s' % kind)
+
+    stop = None
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            break
+        if message[1] == 'stop':
+            stop = message[0]
+            break
+        executor.submit(serve, message)
+    # finish what is in flight and save the histories and archives before the process goes away
+    executor.shutdown(wait=True)
+    for handler in list(handlers.values()):
+        handler.dump_data()
+    if stop is not None:
+        reply(stop, True, None)
+    os._exit(0)
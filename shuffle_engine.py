@@ -0,0 +1,104 @@
+import random
+
+MODES = ('uniform', 'type', 'admin')
+
+
+def uniform(units, rng=random):
+    rng.shuffle(units)
+    return units
+
+
+def spread(units, key, max_run, rng=random):
+    # Random order in which no more than max_run consecutive units share a key, wherever the counts allow it.
+    # Units are bucketed by key and each bucket shuffled, then buckets are drawn from in proportion to what
+    # they have left. A bucket is forced when waiting any longer would leave it too large to spread out.
+    # Bucket sizes live in a Fenwick tree for the weighted draw and in lists by size for finding the largest,
+    # so a step is O(log k) for k distinct keys and the whole shuffle O(n log k).
+    buckets = {}
+    for unit in units:
+        buckets.setdefault(key(unit), []).append(unit)
+    for bucket in buckets.values():
+        rng.shuffle(bucket)
+    remaining = len(units)
+    if remaining == 0:
+        return units
+    keys = list(buckets)
+    counts = [len(buckets[candidate]) for candidate in keys]
+    tree = [0] * (len(keys) + 1)
+    for (index, count) in enumerate(counts):
+        tree_add(tree, index, count)
+    # keys by bucket size, sizes only shrink so the largest is found by walking top down once overall
+    by_count = {}
+    for (index, count) in enumerate(counts):
+        by_count.setdefault(count, {})[index] = None
+    top = max(counts)
+    # when one key is too common to keep runs that short, allow the shortest runs that spread it evenly
+    max_run = max(max_run, -(-top // (remaining - top + 1)))
+    (last, run) = (None, 0)
+    for position in range(len(units)):
+        while len(by_count.get(top, ())) == 0:
+            top -= 1
+        largest = next(iter(by_count[top]))
+        choice = None
+        if largest != last or run < max_run:
+            if counts[largest] > (remaining - counts[largest]) * max_run:
+                choice = largest
+        if choice is None:
+            if last is not None and run >= max_run and counts[last] < remaining:
+                # draw from the other keys, skipping over the share of the one that ran out its limit
+                pick = min(int(rng.random() * (remaining - counts[last])), remaining - counts[last] - 1)
+                if pick >= tree_prefix(tree, last):
+                    pick += counts[last]
+            else:
+                # nothing is blocked, or only the key that just ran out its limit is left and the run can't be avoided
+                pick = min(int(rng.random() * remaining), remaining - 1)
+            choice = tree_find(tree, pick)
+        units[position] = buckets[keys[choice]].pop()
+        del by_count[counts[choice]][choice]
+        counts[choice] -= 1
+        if counts[choice] > 0:
+            by_count.setdefault(counts[choice], {})[choice] = None
+        tree_add(tree, choice, -1)
+        remaining -= 1
+        if choice == last:
+            run += 1
+        else:
+            (last, run) = (choice, 1)
+    return units
+
+
+def tree_add(tree, index, delta):
+    index += 1
+    while index < len(tree):
+        tree[index] += delta
+        index += index & -index
+
+
+def tree_prefix(tree, index):
+    # total count of the keys before index
+    total = 0
+    while index > 0:
+        total += tree[index]
+        index -= index & -index
+    return total
+
+
+def tree_find(tree, pick):
+    # index of the key whose share of the running total holds pick
+    index = 0
+    step = 1 << ((len(tree) - 1).bit_length() - 1)
+    while step > 0:
+        if index + step < len(tree) and tree[index + step] <= pick:
+            index += step
+            pick -= tree[index]
+        step >>= 1
+    return index
+
+
+def shuffle(units, mode='uniform', max_run=2, rng=random):
+    # units are lists of posts that move together (a forwarded album), shuffled in place
+    if mode == 'type':
+        return spread(units, lambda unit: unit[0].type, max_run, rng)
+    if mode == 'admin':
+        return spread(units, lambda unit: unit[0].admin, max_run, rng)
+    return uniform(units, rng)
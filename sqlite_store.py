@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS posts (
+    channel_id INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    caption TEXT,
+    media_group TEXT,
+    admin_id INTEGER,
+    digest TEXT,
+    PRIMARY KEY (channel_id, post_id)
+);
+CREATE INDEX IF NOT EXISTS posts_position ON posts (channel_id, position);
+CREATE TABLE IF NOT EXISTS post_times (
+    channel_id INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    PRIMARY KEY (channel_id, time)
+);
+CREATE TABLE IF NOT EXISTS user_prefs (
+    user_id INTEGER PRIMARY KEY,
+    timezone TEXT NOT NULL
+);
+"""
+
+# channel config keys that live in their own tables rather than in channels.settings
+TABLE_KEYS = ('queued_posts', 'post_times')
+
+
+class SqliteStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(posts)")]
+        for (column, type) in (('media_group', 'TEXT'), ('admin_id', 'INTEGER'), ('digest', 'TEXT')):
+            if column not in columns:
+                self.connection.execute("ALTER TABLE posts ADD COLUMN %s %s" % (column, type))
+
+    def channel_ids(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT channel_id FROM channels").fetchall()
+        return [str(row[0]) for row in rows]
+
+    def has_channel(self, channel_id):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM channels WHERE channel_id = ?", (channel_id,)).fetchone()
+        return row is not None
+
+    def load_channel(self, channel_id):
+        with self.lock:
+            row = self.connection.execute("SELECT settings FROM channels WHERE channel_id = ?",
+                                          (channel_id,)).fetchone()
+            if row is None:
+                return None
+            config = json.loads(row[0])
+            config['queued_posts'] = [list(post) for post in self.connection.execute(
+                "SELECT post_id, type, payload, caption, media_group, admin_id, digest FROM posts "
+                "WHERE channel_id = ? ORDER BY position", (channel_id,))]
+            config['post_times'] = [time for (time,) in self.connection.execute(
+                "SELECT time FROM post_times WHERE channel_id = ? ORDER BY rowid", (channel_id,))]
+        return config
+
+    def import_channel(self, channel_id, config, posts):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM posts WHERE channel_id = ?", (channel_id,))
+            self.connection.execute("DELETE FROM post_times WHERE channel_id = ?", (channel_id,))
+            self._save_settings(channel_id, config)
+            self._insert_posts(channel_id, posts, 0)
+            self.connection.executemany("INSERT OR IGNORE INTO post_times (channel_id, time) VALUES (?, ?)",
+                                        [(channel_id, time) for time in config['post_times']])
+
+    def save_settings(self, channel_id, config):
+        with self.lock, self.connection:
+            self._save_settings(channel_id, config)
+
+    def add_post(self, channel_id, post):
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT MAX(position) FROM posts WHERE channel_id = ?",
+                                          (channel_id,)).fetchone()
+            if row[0] is None:
+                position = 0
+            else:
+                position = row[0] + 1
+            self._insert_posts(channel_id, [post], position)
+
+    def remove_post(self, channel_id, post_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM posts WHERE channel_id = ? AND post_id = ?", (channel_id, post_id))
+
+    def reorder(self, channel_id, posts):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE posts SET position = ? WHERE channel_id = ? AND post_id = ?",
+                                        [(position, channel_id, post.id) for (position, post) in enumerate(posts)])
+
+    def add_time(self, channel_id, time_string):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO post_times (channel_id, time) VALUES (?, ?)",
+                                    (channel_id, time_string))
+
+    def remove_time(self, channel_id, time_string):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM post_times WHERE channel_id = ? AND time = ?",
+                                    (channel_id, time_string))
+
+    def release_channel(self, channel_id):
+        # rows are shared through the database, another process can take the channel over as is
+        pass
+
+    def timezone_prefs(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT user_id, timezone FROM user_prefs").fetchall()
+        return {str(user_id): json.loads(timezone) for (user_id, timezone) in rows}
+
+    def set_timezone(self, user_id, timezone):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO user_prefs (user_id, timezone) VALUES (?, ?)",
+                                    (user_id, json.dumps(timezone)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _save_settings(self, channel_id, config):
+        settings = {key: value for (key, value) in config.items() if key not in TABLE_KEYS}
+        self.connection.execute("INSERT OR REPLACE INTO channels (channel_id, settings) VALUES (?, ?)",
+                                (channel_id, json.dumps(settings)))
+
+    def _insert_posts(self, channel_id, posts, position):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO posts "
+            "(channel_id, post_id, position, type, payload, caption, media_group, admin_id, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(channel_id, post.id, position + offset, post.type, post.payload, post.caption, post.group, post.admin,
+              post.digest)
+             for (offset, post) in enumerate(posts)])
@@ -0,0 +1,39 @@
+import unittest
+
+from dedup_index import DedupIndex, media_digest, post_digest
+from post_queue import QueuedPost
+
+
+class PhotoSize:
+    def __init__(self, file_id, file_size, width=1280, height=720):
+        self.file_id = file_id
+        self.file_size = file_size
+        self.width = width
+        self.height = height
+
+
+class DedupIndexTest(unittest.TestCase):
+    def test_forwarded_copies_match_without_file_unique_id(self):
+        # python-telegram-bot 10.x gives every forwarded copy its own file_id and no file_unique_id
+        self.assertEqual(media_digest(PhotoSize('AgAD1', 48213)), media_digest(PhotoSize('AgAD2', 48213)))
+        self.assertNotEqual(media_digest(PhotoSize('AgAD1', 48213)), media_digest(PhotoSize('AgAD1', 48214)))
+        self.assertNotEqual(media_digest(PhotoSize('AgAD1', 48213)),
+                            media_digest(PhotoSize('AgAD1', 48213, 720, 1280)))
+
+    def test_duplicate_queued_anyway(self):
+        # removing either copy of a duplicate queued anyway keeps the other one found
+        index = DedupIndex()
+        (first, second) = (QueuedPost(1, 't', 'hello'), QueuedPost(2, 't', 'Hello'))
+        index.add(first)
+        index.add(second)
+        index.discard(first)
+        self.assertEqual(index.find(post_digest(second)), ('queued', 2))
+        index.add(first)
+        index.discard(second)
+        self.assertEqual(index.find(post_digest(first)), ('queued', 1))
+        index.discard(first)
+        self.assertEqual(index.find(post_digest(first)), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
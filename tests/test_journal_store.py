@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from journal_store import JournalStore
+from post_queue import PostQueue, QueuedPost
+
+CHANNEL_ID = -1001234567890
+
+
+class JournalStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def mutate(self, store, queue, config):
+        for post in (QueuedPost(3, 'v', 'VIDEO_3', None, 'album', 7), QueuedPost(4, 't', 'fourth')):
+            queue.append(post)
+            store.add_post(CHANNEL_ID, post)
+        queue.remove(1)
+        store.remove_post(CHANNEL_ID, 1)
+        posts = queue.reorder([queue.get(4), queue.get(2), queue.get(3)])
+        store.reorder(CHANNEL_ID, posts)
+        store.add_time(CHANNEL_ID, '16:00')
+        store.remove_time(CHANNEL_ID, '04:00')
+        config['per_post'] = 1
+        store.save_settings(CHANNEL_ID, config)
+
+    def round_trip(self, compact_size):
+        # the queue replayed after reopening matches the in-memory queue the mutations were applied to
+        queue = PostQueue([QueuedPost(1, 't', 'first'), QueuedPost(2, 'p', 'PHOTO_2', 'caption', 'album', 7, 'ab')])
+        config = {'admins': [7], 'per_post': 2, 'post_times': ['04:00'], 'queued_posts': []}
+        store = JournalStore(self.directory, compact_size=compact_size)
+        store.import_channel(CHANNEL_ID, config, queue)
+        self.mutate(store, queue, config)
+        store.set_timezone(7, 'Europe/Amsterdam')
+        store.close()
+        store.compactor.join()
+
+        store = JournalStore(self.directory)
+        self.assertEqual(store.channel_ids(), [str(CHANNEL_ID)])
+        loaded = store.load_channel(CHANNEL_ID)
+        self.assertEqual(loaded['queued_posts'], queue.to_data())
+        self.assertEqual(loaded['post_times'], ['16:00'])
+        self.assertEqual((loaded['admins'], loaded['per_post']), ([7], 1))
+        self.assertEqual(store.timezone_prefs(), {'7': 'Europe/Amsterdam'})
+        store.close()
+
+    def test_round_trip(self):
+        self.round_trip(1 << 20)
+
+    def test_round_trip_after_compaction(self):
+        # every commit passes compact_size, so records are folded into the snapshot while more are appended
+        self.round_trip(1)
+
+    def test_load_during_compaction(self):
+        # a channel loaded while its journal is being folded into the snapshot still has every committed post
+        store = JournalStore(self.directory, commit_interval=0, compact_size=256)
+        store.import_channel(CHANNEL_ID, {'post_times': [], 'queued_posts': []}, [])
+        committed = [0]
+        stop = threading.Event()
+
+        def add_posts():
+            while not stop.is_set():
+                store.add_post(CHANNEL_ID, QueuedPost(committed[0] + 1, 't', 'post %d' % (committed[0] + 1)))
+                committed[0] += 1
+
+        writer = threading.Thread(target=add_posts)
+        writer.start()
+        try:
+            deadline = time.time() + 2
+            while time.time() < deadline:
+                expected = committed[0]
+                loaded = store.load_channel(CHANNEL_ID)['queued_posts']
+                self.assertGreaterEqual(len(loaded), expected)
+                self.assertEqual([data[0] for data in loaded], list(range(1, len(loaded) + 1)))
+        finally:
+            stop.set()
+            writer.join()
+            store.close()
+            store.compactor.join()
+
+    def test_release_channel(self):
+        # a channel handed to another process is appended to there and no longer compacted from here
+        source = JournalStore(self.directory, compact_size=1)
+        source.import_channel(CHANNEL_ID, {'post_times': [], 'queued_posts': []}, [])
+        source.add_post(CHANNEL_ID, QueuedPost(1, 't', 'first'))
+        source.release_channel(CHANNEL_ID)
+        target = JournalStore(self.directory, compact_size=1)
+        self.assertEqual(target.load_channel(CHANNEL_ID)['queued_posts'], [[1, 't', 'first', None]])
+        target.add_post(CHANNEL_ID, QueuedPost(2, 't', 'second'))
+        for store in (source, target):
+            store.close()
+            store.compactor.join()
+        self.assertEqual(source.streams, {})
+        loaded = JournalStore(self.directory).load_channel(CHANNEL_ID)
+        self.assertEqual([data[0] for data in loaded['queued_posts']], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
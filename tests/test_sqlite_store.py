@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from post_queue import PostQueue, QueuedPost
+from sqlite_store import SqliteStore
+
+CHANNEL_ID = -1001234567890
+
+
+class SqliteStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'queue.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        # the queue read back after reopening matches the in-memory queue the mutations were applied to
+        queue = PostQueue([QueuedPost(1, 't', 'first'), QueuedPost(2, 'p', 'PHOTO_2', 'caption', 'album', 7, 'ab')])
+        config = {'admins': [7], 'per_post': 2, 'post_times': ['04:00'], 'queued_posts': []}
+        store = SqliteStore(self.path)
+        store.import_channel(CHANNEL_ID, config, queue)
+        for post in (QueuedPost(3, 'v', 'VIDEO_3', None, 'album', 7), QueuedPost(4, 't', 'fourth')):
+            queue.append(post)
+            store.add_post(CHANNEL_ID, post)
+        queue.remove(1)
+        store.remove_post(CHANNEL_ID, 1)
+        posts = queue.reorder([queue.get(4), queue.get(2), queue.get(3)])
+        store.reorder(CHANNEL_ID, posts)
+        store.add_time(CHANNEL_ID, '16:00')
+        store.remove_time(CHANNEL_ID, '04:00')
+        config['per_post'] = 1
+        store.save_settings(CHANNEL_ID, config)
+        store.set_timezone(7, 'Europe/Amsterdam')
+        store.close()
+
+        store = SqliteStore(self.path)
+        self.assertEqual(store.channel_ids(), [str(CHANNEL_ID)])
+        loaded = store.load_channel(CHANNEL_ID)
+        self.assertEqual([QueuedPost.from_data(data).to_data() for data in loaded['queued_posts']], queue.to_data())
+        self.assertEqual(loaded['post_times'], ['16:00'])
+        self.assertEqual((loaded['admins'], loaded['per_post']), ([7], 1))
+        self.assertEqual(store.timezone_prefs(), {'7': 'Europe/Amsterdam'})
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
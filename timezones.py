@@ -0,0 +1,154 @@
+import datetime
+import logging
+import threading
+
+# zoneinfo ships with Python 3.9+, older interpreters fall back to pytz if it is installed
+try:
+    from zoneinfo import ZoneInfo, available_timezones
+    pytz = None
+except ImportError:
+    ZoneInfo = None
+    try:
+        import pytz
+    except ImportError:
+        pytz = None
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+REGIONS = ('Africa', 'America', 'Antarctica', 'Arctic', 'Asia', 'Atlantic', 'Australia', 'Europe', 'Indian',
+           'Pacific', 'Etc')
+
+zones = {}
+tables = {}
+lock = threading.Lock()
+zone_names = None
+unknown_prefs = set()
+
+
+def available():
+    return ZoneInfo is not None or pytz is not None
+
+
+def all_zones():
+    # IANA names grouped by region, sorted, e.g. {'Europe': ['Europe/Amsterdam', ...]}
+    global zone_names
+    if zone_names is None:
+        if ZoneInfo is not None:
+            names = available_timezones()
+        else:
+            names = pytz.common_timezones
+        groups = {}
+        for name in sorted(names):
+            region = name.split('/')[0]
+            if region in REGIONS:
+                groups.setdefault(region, []).append(name)
+        zone_names = groups
+    return zone_names
+
+
+def get_zone(name):
+    if name not in zones:
+        if ZoneInfo is not None:
+            zones[name] = ZoneInfo(name)
+        elif pytz is not None:
+            zones[name] = pytz.timezone(name)
+        else:
+            raise KeyError(name)
+    return zones[name]
+
+
+def is_zone(name):
+    if not available() or not isinstance(name, str) or '/' not in name and name != 'UTC':
+        return False
+    try:
+        get_zone(name)
+        return True
+    except Exception:
+        return False
+
+
+def parse_offset(pref):
+    # legacy prefs are whole hours (-5, "+3") or "+5:30" style offsets, returned in minutes
+    if isinstance(pref, int):
+        return pref * 60
+    try:
+        pref = pref.strip()
+        sign = -1 if pref.startswith('-') else 1
+        (hours, _, minutes) = pref.lstrip('+-').partition(':')
+        return sign * (int(hours) * 60 + int(minutes or 0))
+    except (AttributeError, ValueError):
+        # a zone name stored while zoneinfo or pytz was available, or a corrupt pref, reads as UTC
+        if pref not in unknown_prefs:
+            unknown_prefs.add(pref)
+            logger.warning('Unknown time zone preference %r, using UTC' % (pref,))
+        return 0
+
+
+def zone_offset(zone, timestamp):
+    moment = datetime.datetime.fromtimestamp(timestamp, zone)
+    return int(moment.utcoffset().total_seconds()) // 60
+
+
+def day_table(name, day):
+    # UTC offset of a zone over one UTC day: (transition timestamp or None, offset before, offset after).
+    # Tables are keyed by day, so a DST change is picked up as soon as the date it happens on is looked up.
+    key = (name, day)
+    table = tables.get(key)
+    if table is None:
+        zone = get_zone(name)
+        (start, end) = (day * DAY, (day + 1) * DAY - 1)
+        (before, after) = (zone_offset(zone, start), zone_offset(zone, end))
+        transition = None
+        if before != after:
+            # offsets only change at transitions, bisect the day down to the second it happens
+            (low, high) = (start, end)
+            while high - low > 1:
+                middle = (low + high) // 2
+                if zone_offset(zone, middle) == before:
+                    low = middle
+                else:
+                    high = middle
+            transition = high
+        table = (transition, before, after)
+        with lock:
+            if len(tables) > 10000:
+                tables.clear()
+            tables[key] = table
+    return table
+
+
+def utc_offset(pref, timestamp):
+    # minutes to add to UTC at timestamp for a time zone pref, either an IANA name or a legacy offset
+    if is_zone(pref):
+        (transition, before, after) = day_table(pref, int(timestamp // DAY))
+        if transition is None or timestamp < transition:
+            return before
+        return after
+    return parse_offset(pref)
+
+
+def to_local_minute(pref, minute, timestamp):
+    # minute of the day in UTC to the pref's local minute of the day around timestamp
+    return (minute + utc_offset(pref, timestamp - timestamp % DAY + minute * 60)) % 1440
+
+
+def to_utc_minute(pref, minute, timestamp):
+    # local minute of the day to UTC, using the offset in effect at that local time on timestamp's date
+    day_start = timestamp - timestamp % DAY
+    guess = utc_offset(pref, day_start + minute * 60)
+    return (minute - utc_offset(pref, day_start + (minute - guess) * 60)) % 1440
+
+
+def offset_text(offset):
+    text = 'UTC%s%d' % ('-' if offset < 0 else '+', abs(offset) // 60)
+    if offset % 60:
+        text += ':%02d' % (abs(offset) % 60)
+    return text
+
+
+def describe(pref, timestamp):
+    text = offset_text(utc_offset(pref, timestamp))
+    if is_zone(pref):
+        return '%s (%s)' % (pref.replace('_', ' '), text)
+    return text
@@ -0,0 +1,97 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path not in webhook.routes:
+            self.send_error(404)
+            return
+        token = self.headers.get(SECRET_HEADER, '')
+        if webhook.secret_token and not hmac.compare_digest(token, webhook.secret_token):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not webhook.enqueue(self.path, data):
+            # Telegram redelivers updates that weren't acknowledged, so shed load instead of blocking
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+# Receives Telegram updates over HTTP and hands them to the dispatcher's handlers from a pool of worker
+# threads. Updates wait in a bounded queue; once it is full, requests are refused with 503. Each bot hosted by
+# the process has its own path, routed to its own dispatcher.
+class WebhookServer:
+    def __init__(self, dispatcher, bot, listen='0.0.0.0', port=8443, path='/', secret_token=None, workers=4,
+                 queue_size=1000):
+        self.secret_token = secret_token
+        self.workers = workers
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.server = ThreadingHTTPServer((listen, port), WebhookRequestHandler)
+        self.server.webhook = self
+        self.routes = {path: (dispatcher, bot)}
+        self.threads = []
+
+    def add_route(self, path, dispatcher, bot):
+        self.routes[path] = (dispatcher, bot)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def enqueue(self, path, data):
+        try:
+            self.updates.put_nowait((path, data))
+        except queue.Full:
+            return False
+        return True
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name='webhook-worker-%d' % index, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self.server.serve_forever, name='webhook-server', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        logger.info('Webhook server listening on port %d' % self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _work(self):
+        while True:
+            (path, data) = self.updates.get()
+            (dispatcher, bot) = self.routes[path]
+            try:
+                dispatcher.process_update(Update.de_json(data, bot))
+            except Exception as e:
+                logger.error('Failed to process update %s: %s' % (data.get('update_id'), e))